@@ -28,12 +28,14 @@ import json
 from tosasitill_123pan.class123 import Pan123
 from tosasitill_123pan import config
 from utils.mpush import MPush
+from utils.bandwidth import limiter, parse_rate, UPLOAD, DOWNLOAD
 from utils.logger import log_runtime, log_error, log_command, log_exit
 from utils.input_handler import setup_readline, normalize_path
 from utils.command_handler import (
     create_argument_parser,
     parse_upload_command,
     handle_mget_command,
+    handle_limit_command,
     execute_upload,
     validate_upload_path,
     format_upload_mode
@@ -83,7 +85,13 @@ def print_interactive_help():
     print("  <path> -f                 Force overwrite existing files")
     print("  <path> -k                 Keep both on conflict")
     print("  <path> --no-skip          Disable MD5 duplicate check")
-    print("  mget <url> [-o file] [-t n] Download file")
+    print("  <path> --part-workers n   Upload n parts of a file in parallel")
+    print("  <path> --rehash           Ignore cached MD5s and re-hash files")
+    print("  <path> --mmap             Hash and upload through a memory map")
+    print("  <path> --auto-concurrency Adapt parallel part uploads to the network")
+    print("  mget <url> [-o file] [-t n] [-a] [--md5 hash] Download file (-a: adaptive threads)")
+    print("  limit [up|down <rate|off>] Show or set bandwidth limits (e.g. limit up 2M)")
+    print("  limit schedule 09:00-18:00 <up> <down>  Time-of-day limits")
     print("  0                         Exit program")
     print("  Ctrl+C twice              Exit program")
     print("="*60 + "\n")
@@ -131,6 +139,11 @@ def run_interactive_mode(mpush, default_sure_option, default_skip_existing):
                 handle_mget_command(user_input)
                 continue
 
+            # Bandwidth limit command
+            if user_input == "limit" or user_input.startswith("limit "):
+                handle_limit_command(user_input)
+                continue
+
             # Parse upload command
             cmd = parse_upload_command(user_input, default_sure_option, default_skip_existing)
             
@@ -151,7 +164,11 @@ def run_interactive_mode(mpush, default_sure_option, default_skip_existing):
                 cmd['path'], 
                 cmd['sure_option'], 
                 cmd['dest_name'], 
-                cmd['skip_existing']
+                cmd['skip_existing'],
+                part_workers=cmd['part_workers'],
+                rehash=cmd['rehash'],
+                use_mmap=cmd['use_mmap'],
+                auto_concurrency=cmd['auto_concurrency']
             )
 
         except KeyboardInterrupt:
@@ -173,7 +190,8 @@ def main():
     """Main entry point for 123Pan Cloud Upload CLI Tool.
     
     Supports both command-line mode and interactive mode.
-    - Command-line: python app.py <path> [-f] [-k] [-d dest] [--no-skip]
+    - Command-line: python app.py <path> [-f] [-k] [-d dest] [--no-skip] [--rehash] [--mmap] [--auto-concurrency] [--part-workers n]
+      [--limit-up rate] [--limit-down rate]
     - Interactive: python app.py (then enter commands)
     - QR login: python app.py --qr (force QR code login)
     
@@ -188,7 +206,15 @@ def main():
     setup_readline()
     
     parser = create_argument_parser()
+    parser.add_argument("--limit-up", type=parse_rate, help="Upload bandwidth limit (e.g. 2M, 512K)")
+    parser.add_argument("--limit-down", type=parse_rate, help="Download bandwidth limit (e.g. 10M)")
     args = parser.parse_args()
+    if args.part_workers is not None and args.part_workers < 1:
+        parser.error("--part-workers must be at least 1")
+    if args.limit_up:
+        limiter.set_limit(UPLOAD, args.limit_up)
+    if args.limit_down:
+        limiter.set_limit(DOWNLOAD, args.limit_down)
 
     # Set conflict handling strategy
     if args.force:
@@ -241,7 +267,7 @@ def main():
                 log_runtime("User chose account/password login")
                 pan = Pan123(readfile=False, input_pwd=True)
 
-        mpush = MPush(pan)
+        mpush = MPush(pan, part_workers=args.part_workers)
         print("Login successful!")
         log_runtime("Login successful, entering main mode")
     except Exception as e:
@@ -261,7 +287,10 @@ def main():
         dest_name = normalize_path(args.dest) if args.dest else None
         
         print(format_upload_mode(sure_option, skip_existing))
-        execute_upload(mpush, path, sure_option, dest_name, skip_existing)
+        execute_upload(
+            mpush, path, sure_option, dest_name, skip_existing,
+            rehash=args.rehash, use_mmap=args.mmap, auto_concurrency=args.auto_concurrency
+        )
         log_runtime("CLI mode upload completed, exiting")
         return
 
@@ -2,13 +2,15 @@
 # -*- coding: utf-8 -*-
 
 import re
-import time
 import os
 import json
 import base64
 import requests
 from . import config
+from .session import create_session, ensure_pool_size
 from utils.logger import log_runtime, log_error
+from utils.mget import MGet
+from utils.download_state import DownloadState
 
 
 class Pan123:
@@ -89,6 +91,11 @@ class Pan123:
             Exception: If token is invalid and no password credentials are available
                        for re-login, or if QR/password login fails
         """
+        # Keep-alive sessions: one for www.123pan.cn API calls, one for
+        # storage-node / download hosts (presigned URLs must not carry auth headers)
+        self.session = create_session(governed=True)
+        self.transfer_session = create_session()
+
         self.RecycleList = None
         self.list = None
         self.userName = ""
@@ -157,6 +164,16 @@ class Pan123:
                 log_error(msg)
                 raise Exception(msg)
 
+    def ensure_pool_size(self, api_connections, transfer_connections):
+        """Size the keep-alive pools for the number of threads about to use them
+
+        Args:
+            api_connections: Threads making concurrent API calls
+            transfer_connections: Threads transferring data to/from storage nodes
+        """
+        ensure_pool_size(self.session, api_connections)
+        ensure_pool_size(self.transfer_session, transfer_connections)
+
     def _build_auth_header(self):
         header = self._header_authenticated_template.copy()
         header["Authorization"] = self.authorization
@@ -213,7 +230,7 @@ class Pan123:
         log_runtime(f"Password login attempt for user: {self.userName}")
         data = {"remember": True, "passport": self.userName, "password": self.passWord}
         try:
-            loginRes = requests.post(
+            loginRes = self.session.post(
                 config.URL_SIGN_IN,
                 headers=self.headerOnlyUsage,
                 json=data,
@@ -257,22 +274,33 @@ class Pan123:
         except OSError as e:
             log_error(f"Failed to save credentials: {e}")
 
-    def get_dir(self, _recursion_depth=0):
-        """Fetch file list from current directory
+    def get_dir(self):
+        """Fetch file list from current directory into self.list
 
-        Retrieves paginated file listing from 123Pan Cloud. Handles IP ban
-        detection and automatically retries after 20 seconds if banned.
+        Returns:
+            int: Response code (0 for success, other values for failure)
+        """
+        code, lists = self.list_dir(self.parentFileId)
+        if code == 0:
+            self.list = lists
+        return code
+
+    def list_dir(self, parent_id):
+        """Fetch the file list of any folder without changing the current directory
+
+        Retrieves paginated file listing from 123Pan Cloud. IP bans are
+        handled by the session's ApiGovernor, which pauses all API calls and
+        repeats the request; a ban that outlasts its retries is returned as
+        code 403. Does not touch parentFileId or list, so it is safe to call from
+        worker threads.
 
         Args:
-            _recursion_depth: Internal counter to prevent infinite recursion (max 3 retries)
+            parent_id: Folder ID to list
 
         Returns:
-            int: Response code (0 for success, other values for failure)
+            tuple: (code, items) - code is 0 on success; items is the list of
+                file info dicts (empty on failure)
         """
-        if _recursion_depth >= 3:
-            print("get_dir: Max retry count reached, giving up")
-            return -1
-
         code = 0
         page = 1
         lists = []
@@ -285,7 +313,7 @@ class Pan123:
                 "next": 0,
                 "orderBy": "file_id",
                 "orderDirection": "desc",
-                "parentFileId": str(self.parentFileId),
+                "parentFileId": str(parent_id),
                 "trashed": False,
                 "SearchData": "",
                 "Page": str(page),
@@ -293,25 +321,21 @@ class Pan123:
             }
 
             try:
-                a = requests.get(config.URL_FILE_LIST, headers=self.headerLogined, params=params, timeout=config.TIMEOUT_MEDIUM)
+                a = self.session.get(config.URL_FILE_LIST, headers=self.headerLogined, params=params, timeout=config.TIMEOUT_MEDIUM)
             except requests.exceptions.RequestException as e:
                 print(f"get_dir: Request failed: {e}")
-                return -1
+                return -1, []
 
             try:
                 text = a.json()
             except ValueError as e:
                 print(f"get_dir: Failed to parse response: {e}")
-                return -1
+                return -1, []
 
             code = text['code']
             if code != 0:
                 print(f"get_dir: Error code={code}: {a.text}")
-                if code == 403:
-                    print("get_dir: IP banned, sleeping 20s...")
-                    time.sleep(20)
-                    return self.get_dir(_recursion_depth=_recursion_depth + 1)
-                return code
+                return code, []
             lists_page = text['data']['InfoList']
             lists += lists_page
             total = text['data']['Total']
@@ -321,8 +345,7 @@ class Pan123:
         for i, item in enumerate(lists):
             item["FileNum"] = i
 
-        self.list = lists
-        return code
+        return code, lists
 
     def show(self):
         """Display current directory listing with file numbers, sizes and names"""
@@ -367,7 +390,7 @@ class Pan123:
             }
 
         try:
-            linkRes = requests.post(
+            linkRes = self.session.post(
                 down_request_url,
                 headers=self.headerLogined,
                 json=down_request_data,
@@ -391,7 +414,7 @@ class Pan123:
         downLoadUrl = base64.b64decode(Base64Url).decode("utf-8")
 
         try:
-            nextToGet = requests.get(downLoadUrl, timeout=config.TIMEOUT_SHORT).json()
+            nextToGet = self.transfer_session.get(downLoadUrl, timeout=config.TIMEOUT_SHORT).json()
         except requests.exceptions.RequestException as e:
             print(f"link: Failed to get redirect URL: {e}")
             return -1
@@ -402,67 +425,48 @@ class Pan123:
 
         return redirect_url
 
-    def download(self, file_number):
+    def download(self, file_number, num_threads=None, verify=True):
         """Download a file from 123Pan Cloud
 
+        The transfer runs on the MGet engine: parallel ranges written in
+        place, large reads and a progress bar refreshed twice a second. An
+        interrupted download keeps a .mget-state sidecar and continues from
+        there when the file is downloaded again (with a freshly resolved link).
+
         Args:
             file_number: 0-indexed file number in the current directory listing
+            num_threads: Parallel ranges (default: config.DEFAULT_DOWNLOAD_THREADS)
+            verify: If True, check the data against the listing's MD5 Etag
+                while it is written, and download again on a mismatch
+
+        Returns:
+            float: Elapsed seconds, or None if the download failed or was cancelled
         """
         fileDetail = self.list[file_number]
-        downLoadUrl = self.link(file_number, showlink=False)
         name = fileDetail['FileName']
-        if os.path.exists(name):
+        if os.path.exists(name) and not DownloadState.pending(name):
             print(f"File {name} already exists, do you want to overwrite?")
             sure = input("Enter 1 to overwrite, 2 to cancel: ")
             if sure != '1':
-                return
-        try:
-            down = requests.get(downLoadUrl, stream=True, timeout=config.TIMEOUT_LONG)
-        except requests.exceptions.RequestException as e:
-            print(f"download: Request failed: {e}")
-            return
+                return None
+        downLoadUrl = self.link(file_number, showlink=False)
+        if not isinstance(downLoadUrl, str):
+            print(f"download: Failed to get download link for {name}")
+            return None
 
-        size = int(down.headers['content-length'])
-        content_size = int(size)
-        data_count = 0
-        if size > 1048576:
-            size_print = str(round(size / 1048576, 2)) + "M"
-        else:
-            size_print = str(round(size / 1024, 2)) + "K"
-        print(name + "    " + size_print)
-        time1 = time.time()
-        time_temp = time1
-        data_count_temp = 0
-        with open(name, "wb") as f:
-            for i in down.iter_content(1024):
-                f.write(i)
-                done_block = int((data_count / content_size) * 50)
-                data_count = data_count + len(i)
-                now_jd = (data_count / content_size) * 100
-                time1 = time.time()
-                pass_time = time1 - time_temp
-                if pass_time > 1:
-                    time_temp = time1
-                    pass_data = int(data_count) - int(data_count_temp)
-                    data_count_temp = data_count
-                    speed = pass_data / int(pass_time)
-                    speed_M = speed / 1048576
-                    if speed_M > 1:
-                        speed_print = str(round(speed_M, 2)) + "M/S"
-                    else:
-                        speed_print = str(round(speed_M * 1024, 2)) + "K/S"
-                    print(
-                        "\r [%s%s] %d%%  %s" % (done_block * '█', ' ' * (50 - 1 - done_block), now_jd, speed_print),
-                        end="")
-                elif data_count == content_size:
-                    print("\r [%s%s] %d%%  %s" % (50 * '█', '', 100, ""), end="")
-        print("\nok")
+        num_threads = num_threads or config.DEFAULT_DOWNLOAD_THREADS
+        downloader = MGet(default_threads=num_threads, session=self.transfer_session)
+        expected_md5 = fileDetail.get('Etag') if verify else None
+        elapsed = downloader.download_multi_thread(downLoadUrl, name, num_threads, expected_md5)
+        if elapsed is not None:
+            log_runtime(f"Downloaded {name} in {elapsed:.2f}s")
+        return elapsed
 
     def recycle(self):
         """Fetch list of files in the recycle bin"""
         url = f"{config.BASE_URL}/b/api/file/list/new?driveId=0&limit=100&next=0&orderBy=fileId&orderDirection=desc&parentFileId=0&trashed=true&Page=1"
         try:
-            recycleRes = requests.get(url, headers=self.headerLogined, timeout=config.TIMEOUT_MEDIUM)
+            recycleRes = self.session.get(url, headers=self.headerLogined, timeout=config.TIMEOUT_MEDIUM)
             jsonRecycle = recycleRes.json()
             self.RecycleList = jsonRecycle['data']['InfoList']
         except requests.exceptions.RequestException as e:
@@ -494,25 +498,42 @@ class Pan123:
                 print("File not found")
                 return
 
+        DeleJson = self.trash(file_detail, operation=operation)
+        if DeleJson is not None:
+            print(DeleJson)
+            print(DeleJson.get('message', ''))
+
+    def trash(self, file_detail, operation=True):
+        """Move a file to (or restore it from) the recycle bin by its info dict
+
+        Unlike delete_file, this does not depend on self.list, so it is safe
+        to call from worker threads.
+
+        Args:
+            file_detail: File info dict as returned by list_dir()
+            operation: True for delete, False for restore
+
+        Returns:
+            dict: Parsed response, or None on failure
+        """
         dataDelete = {
             "driveId": 0,
             "fileTrashInfoList": file_detail,
             "operation": operation
         }
         try:
-            deleteRes = requests.post(
+            deleteRes = self.session.post(
                 config.URL_FILE_TRASH,
                 headers=self.headerLogined,
                 json=dataDelete,
                 timeout=config.TIMEOUT_SHORT
             )
-            DeleJson = deleteRes.json()
-            print(DeleJson)
-            print(DeleJson.get('message', ''))
+            return deleteRes.json()
         except requests.exceptions.RequestException as e:
             print(f"delete_file: Request failed: {e}")
         except ValueError as e:
             print(f"delete_file: Failed to parse response: {e}")
+        return None
 
     def share(self):
         """Create a share link for selected files"""
@@ -546,7 +567,7 @@ class Pan123:
                 "sharePwd": sharePwd,
             }
             try:
-                shareRes = requests.post(
+                shareRes = self.session.post(
                     config.URL_SHARE_CREATE,
                     headers=self.headerLogined,
                     json=data,
@@ -602,19 +623,15 @@ class Pan123:
         self.get_dir()
         self.show()
 
-    def cdById(self, id, _recursion_depth=0):
+    def cdById(self, id):
         """Change current directory by folder ID
 
         Args:
             id: Folder ID to navigate to
-            _recursion_depth: Internal counter to prevent infinite recursion from get_dir() retries
         """
-        if _recursion_depth >= 3:
-            print("cdById: Max retry count reached, giving up")
-            return
         self.parentFileId = id
         self.parentFileList.append(self.parentFileId)
-        code = self.get_dir(_recursion_depth=_recursion_depth)
+        code = self.get_dir()
         self.show()
         if code != 0:
             print(f"cdById: Warning - get_dir returned code {code}")
@@ -675,14 +692,35 @@ class Pan123:
         if parentFileId is None:
             parentFileId = self.parentFileId
 
+        info = self.create_folder(dirname, parentFileId)
+        if info is None:
+            return None
+        print("Created successfully")
+        self.get_dir()
+        return info["FileId"]
+
+    def create_folder(self, dirname, parent_id):
+        """Create a folder without listing or changing the current directory
+
+        Safe to call from worker threads; callers are responsible for checking
+        whether the folder already exists.
+
+        Args:
+            dirname: Name of the folder to create
+            parent_id: Parent folder ID
+
+        Returns:
+            dict: Info dict of the created folder (FileId, FileName, Type, ...),
+                or None on failure
+        """
         dataMk = {
             "driveId": 0, "etag": "", "fileName": dirname,
-            "parentFileId": parentFileId, "size": 0,
+            "parentFileId": parent_id, "size": 0,
             "type": 1, "duplicate": 1, "NotReuse": True,
             "event": "newCreateFolder", "operateType": 1
         }
         try:
-            resMk = requests.post(
+            resMk = self.session.post(
                 config.URL_UPLOAD_REQUEST,
                 headers=self.headerLogined,
                 json=dataMk,
@@ -699,9 +737,7 @@ class Pan123:
 
         code = resJson.get('code')
         if code == 0:
-            print("Created successfully")
-            self.get_dir()
-            return resJson["data"]["Info"]["FileId"]
+            return resJson["data"]["Info"]
         else:
             print(f"mkdir: Create failed, code={code}")
             print(resJson)
@@ -46,11 +46,37 @@ URL_SHARE_CREATE = f"{BASE_URL}/a/api/share/create"
 TIMEOUT_SHORT = 10      # Quick API calls (sign-in, mkdir, etc.)
 TIMEOUT_MEDIUM = 30      # Normal API calls (file list, upload request, etc.)
 TIMEOUT_LONG = 60        # Large file operations (download, multipart finalize, etc.)
-TIMEOUT_UPLOAD_PART = 30 # Each upload chunk to presigned URL
+TIMEOUT_UPLOAD_PART = 30 # Each upload chunk to presigned URL (minimum; scaled with part size)
+UPLOAD_TIMEOUT_MIN_RATE = 256 * 1024  # Bytes/s assumed for part timeouts before any speed is measured
+UPLOAD_TIMEOUT_SLOWDOWN = 4           # Part timeout allows this many times the measured transfer time
+
+# HTTP connection pooling (keep-alive sessions shared by all threads)
+HTTP_POOL_HOSTS = 16     # Distinct hosts (API + storage nodes) with a kept-alive pool
+HTTP_POOL_MAXSIZE = 16   # Default kept-alive connections per host
+
+# API call pacing per endpoint class: (requests/sec, burst); None rate = unlimited
+API_RATE_LIMITS = {
+    "list": (5, 10),       # file/list (folder listings)
+    "upload": (100, 200),  # upload_request, presign, list parts, complete
+    "default": (10, 20),   # everything else (mkdir, trash, download info, ...)
+}
+API_BAN_BACKOFF = 20       # Seconds all API calls pause after an IP ban (doubles while bans repeat)
+API_BAN_BACKOFF_MAX = 300
+API_BAN_RETRIES = 3        # Times a banned call is repeated after the pause before giving up
 
 # Config file
 CREDENTIALS_FILE = "123pan.txt"
 HISTORY_FILE = "~/.123pan_history"
+HASH_CACHE_FILE = "~/.123pan_md5_cache.sqlite3"
+UPLOAD_JOURNAL_FILE = "~/.123pan_upload_journal.json"
+
+# Local MD5 cache: entries unused for this many days are evicted
+HASH_CACHE_MAX_AGE_DAYS = 30
+HASH_CACHE_TIMEOUT = 30  # Seconds to wait while another instance writes to the cache
+
+# Upload journal: resumable sessions older than this are forgotten
+UPLOAD_JOURNAL_MAX_AGE_HOURS = 72
+UPLOAD_JOURNAL_FLUSH_INTERVAL = 2  # Seconds between journal writes while parts complete
 
 # Log directories (three log types: commands, runtime, errors)
 LOG_DIR = "logs"
@@ -59,8 +85,68 @@ LOG_DIR_RUNTIME = os.path.join(LOG_DIR, "runtime")
 LOG_DIR_ERRORS = os.path.join(LOG_DIR, "errors")
 
 # Upload defaults
-DEFAULT_BLOCK_SIZE = 5 * 1024 * 1024  # 5MB chunks
+DEFAULT_BLOCK_SIZE = 5 * 1024 * 1024  # 5MB chunks (also the smallest part size used)
+MAX_BLOCK_SIZE = 64 * 1024 * 1024     # Largest part size chosen by the part-size policy
+MAX_PART_COUNT = 10000                # Server (S3) limit on parts per upload
+TARGET_PART_COUNT = 1000              # Grow parts so big files need about this many
+TARGET_PART_SECONDS = 8               # Grow parts so one takes ~this long at measured speed
+FINALIZE_POLL_INITIAL = 0.25           # First wait before re-polling upload_complete
+FINALIZE_POLL_MAX = 2                  # Longest wait between upload_complete polls
+FINALIZE_DEADLINE = 60                 # Give up finalizing after this many seconds
+# upload_complete errors whose message contains one of these mean "still merging"
+FINALIZE_PENDING_HINTS = ("merg", "process", "wait", "retry", "later", "合并", "处理", "稍后")
 DEFAULT_MAX_WORKERS = 5                # Concurrent upload threads
+DEFAULT_PART_WORKERS = 4               # Concurrent part uploads within a single file
+PRESIGN_BATCH_SIZE = 32                # Presigned part URLs requested per API call
+PRESIGN_URL_TTL = 600                  # Seconds a presigned part URL is trusted before refetching
+PART_BUFFER_COUNT = 16                 # Reusable part buffers shared by all uploads (caps part memory)
+WALK_QUEUE_SIZE = 1000                 # Discovered files waiting to be hashed
+DEFAULT_HASH_WORKERS = 4               # Concurrent MD5 hashing threads in directory uploads
+HASH_QUEUE_SIZE = 64                   # Hashed files waiting for an upload worker
+DEDUP_INDEX_SIZE = 100000              # File sizes and MD5s remembered to group identical files
+HASH_READ_SIZE = 1024 * 1024           # Read buffer for MD5 hashing
+MKDIR_WORKERS = 4                      # Concurrent remote folder creations in directory uploads
+MKDIR_RATE = 10                        # Folder creations per second (shared by all workers)
+MKDIR_BURST = 10
+
+# Bandwidth limits in bytes/sec (None for unlimited); change at runtime with `limit`
+BANDWIDTH_LIMIT_UP = None
+BANDWIDTH_LIMIT_DOWN = None
+# Time-of-day limits overriding the above: ("HH:MM", "HH:MM", upload, download),
+# e.g. [("09:00", "18:00", "2M", None)]; windows may wrap past midnight
+BANDWIDTH_SCHEDULE = []
+BANDWIDTH_SCHEDULE_CHECK = 30          # Seconds between schedule re-evaluations
+BANDWIDTH_BURST_SECONDS = 0.25         # Bucket capacity in seconds of the limit
+BANDWIDTH_CHUNK_SIZE = 64 * 1024       # Largest block sent per token acquisition when limited
+
+# --auto-concurrency: AIMD control of concurrent part PUTs / range GETs
+AUTO_CONCURRENCY_INITIAL = 4           # Starting number of concurrent transfers
+AUTO_CONCURRENCY_MIN = 1
+AUTO_CONCURRENCY_MAX = 16              # Upload ceiling (part buffers bound it as well)
+AUTO_CONCURRENCY_MAX_DOWNLOAD = 32     # Download ceiling
+AUTO_CONCURRENCY_INTERVAL = 2          # Minimum seconds per measurement window
+AUTO_CONCURRENCY_GAIN = 0.05           # Throughput must rise this much (5%) to keep growing
+AUTO_CONCURRENCY_LATENCY_RISE = 1.5    # Time per byte this far above the best means queueing
+AUTO_CONCURRENCY_BACKOFF = 0.5         # Limit multiplier on timeouts, 429/503 or bans
+AUTO_CONCURRENCY_PROBE_WINDOWS = 5     # Flat windows before trying one more transfer
+AUTO_DOWNLOAD_RANGE_SIZE = 8 * 1024 * 1024  # Range size when downloads adapt their thread count
+DOWNLOAD_RANGE_RETRIES = 3              # Retries of one download range after a timeout, 429/503 or 403
+
+# Remote folder listings are reused for this many seconds before relisting
+REMOTE_INDEX_TTL = 600
+
+# Part upload retries (failed part PUTs are retried instead of failing the file)
+UPLOAD_PART_RETRIES = 5          # Retries per part after the first attempt
+UPLOAD_RETRY_BACKOFF = 1         # Seconds before the first retry (doubles per attempt, jittered)
+UPLOAD_RETRY_BACKOFF_MAX = 30    # Longest wait between retries of one part
+UPLOAD_RETRY_BUDGET_FILE = 20    # Retries shared by all parts of one file
+UPLOAD_RETRY_BUDGET_JOB = 200    # Retries shared by all files of one upload command
 
 # Download defaults
 DEFAULT_DOWNLOAD_THREADS = 8
+DOWNLOAD_CHUNK_SIZE = 256 * 1024  # Bytes read from the socket and written per call by range downloads
+DOWNLOAD_STATE_FLUSH_INTERVAL = 2  # Seconds between writes of a download's .mget-state sidecar
+DOWNLOAD_MIN_SPLIT = 2 * 1024 * 1024  # Idle download threads split in-flight ranges down to this size
+DOWNLOAD_VERIFY_BUFFER = 64 * 1024 * 1024  # Out-of-order bytes held for MD5 verification (the rest is read back)
+DOWNLOAD_VERIFY_WAIT = 2  # Seconds a range waits for the MD5 to catch up before its bytes are read back instead
+DOWNLOAD_VERIFY_RETRIES = 1  # Fresh download attempts after an MD5 mismatch
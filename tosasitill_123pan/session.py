@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Pooled HTTP sessions shared by all 123Pan traffic
+
+A requests.Session keeps TCP/TLS connections alive between calls; the
+module-level requests.get/post helpers open a new connection every time.
+Sessions created here mount an HTTPAdapter with one connection pool per
+host (config.HTTP_POOL_HOSTS hosts are kept) and pool_maxsize keep-alive
+connections per host, which should match the number of threads using the
+session. The underlying urllib3 pools are thread-safe, so one session can be
+shared by every ThreadPoolExecutor worker.
+
+The API session is additionally governed: every call to a 123Pan endpoint
+takes a token from the bucket of its endpoint class, and an IP ban seen by
+any thread pauses all API calls for a shared, growing backoff.
+"""
+
+import re
+import time
+import threading
+import requests
+from collections import OrderedDict
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+from . import config
+from utils.ratelimit import TokenBucket
+from utils.logger import log_runtime
+
+# 123Pan reports bans as HTTP 200 with {"code": 403, ...} in the body
+_BAN_BODY = re.compile(rb'"code"\s*:\s*(403|429)\b')
+
+# Endpoint path -> rate limit class (see config.API_RATE_LIMITS); others are "default"
+_ENDPOINT_CLASSES = {
+    urlsplit(url).path: name for url, name in (
+        (config.URL_FILE_LIST, "list"),
+        (config.URL_UPLOAD_REQUEST, "upload"),
+        (config.URL_S3_PREPARE_PARTS, "upload"),
+        (config.URL_S3_LIST_PARTS, "upload"),
+        (config.URL_S3_COMPLETE_MULTIPART, "upload"),
+        (config.URL_UPLOAD_COMPLETE, "upload"),
+    )
+}
+
+
+class ApiGovernor:
+    """Process-wide pacing of 123Pan API calls
+
+    Calls are metered by one token bucket per endpoint class
+    (config.API_RATE_LIMITS). When any response signals an IP ban (HTTP
+    403/429, or code 403/429 in the JSON body), every thread's API calls
+    wait until the shared pause ends. The pause starts at API_BAN_BACKOFF
+    seconds and doubles for each further ban, up to API_BAN_BACKOFF_MAX; it
+    resets once a call succeeds again.
+    """
+
+    def __init__(self):
+        self._buckets = {
+            name: TokenBucket(*limits) for name, limits in config.API_RATE_LIMITS.items()
+        }
+        self._lock = threading.Lock()
+        self._paused_until = 0.0
+        self._backoff = 0.0
+
+    def _bucket(self, url):
+        name = _ENDPOINT_CLASSES.get(urlsplit(url).path, "default")
+        return self._buckets.get(name) or self._buckets["default"]
+
+    def wait(self, url):
+        """Block until a call to url is allowed"""
+        while True:
+            delay = self._paused_until - time.monotonic()
+            if delay <= 0:
+                break
+            time.sleep(delay)
+        self._bucket(url).acquire()
+
+    def is_ban(self, response):
+        """Return True if a response says this client is banned or throttled"""
+        if response.status_code in (403, 429):
+            return True
+        return _BAN_BODY.search(response.content[:256]) is not None
+
+    def report_ban(self, url):
+        """Pause all API calls after a ban (only the first report of a burst counts)"""
+        now = time.monotonic()
+        with self._lock:
+            if now < self._paused_until:
+                return
+            self._backoff = min(config.API_BAN_BACKOFF_MAX, self._backoff * 2 or config.API_BAN_BACKOFF)
+            self._paused_until = now + self._backoff
+            backoff = self._backoff
+        print(f"API rate limited or IP banned ({url.split('?', 1)[0]}), pausing all API calls for {backoff:.0f}s...")
+        log_runtime(f"API ban detected on {url}, pausing API calls for {backoff:.0f}s")
+
+    def report_ok(self):
+        """Reset the ban backoff after a successful call"""
+        if self._backoff and time.monotonic() >= self._paused_until:
+            with self._lock:
+                self._backoff = 0.0
+
+
+# Shared by every governed session in this process
+governor = ApiGovernor()
+
+
+class GovernedSession(requests.Session):
+    """Session whose requests are paced and ban-aware via the ApiGovernor
+
+    A call that comes back banned is repeated after the shared pause, up to
+    API_BAN_RETRIES times; after that the banned response is returned to the
+    caller as before.
+    """
+
+    def request(self, method, url, *args, **kwargs):
+        for _ in range(config.API_BAN_RETRIES + 1):
+            governor.wait(url)
+            response = super().request(method, url, *args, **kwargs)
+            if not governor.is_ban(response):
+                governor.report_ok()
+                return response
+            governor.report_ban(url)
+        return response
+
+
+def _new_adapter(pool_maxsize):
+    return HTTPAdapter(
+        pool_connections=config.HTTP_POOL_HOSTS,
+        pool_maxsize=pool_maxsize,
+        max_retries=0,
+    )
+
+
+def create_session(pool_maxsize=None, governed=False):
+    """Create a keep-alive session with per-host connection pools
+
+    Args:
+        pool_maxsize: Connections kept per host (default: config.HTTP_POOL_MAXSIZE)
+        governed: If True, return a GovernedSession (use for 123Pan API calls only)
+
+    Returns:
+        requests.Session: Session with pooled adapters mounted
+    """
+    session = GovernedSession() if governed else requests.Session()
+    session.pool_maxsize = pool_maxsize or config.HTTP_POOL_MAXSIZE
+    adapter = _new_adapter(session.pool_maxsize)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+_resize_lock = threading.Lock()
+
+
+def ensure_pool_size(session, pool_maxsize):
+    """Grow a session's per-host pools to hold at least pool_maxsize connections
+
+    A larger adapter replaces the current one. The session's adapter
+    mapping is swapped in a single assignment, so threads looking up an
+    adapter meanwhile never see it half-updated. The old adapter is then
+    closed: its idle connections are closed at once, and requests still in
+    flight finish and close theirs. Callers should size the session once
+    per job rather than per request. Pools are never shrunk.
+
+    Args:
+        session: Session created by create_session()
+        pool_maxsize: Number of threads that will use the session concurrently
+    """
+    if pool_maxsize <= getattr(session, "pool_maxsize", 0):
+        return
+    with _resize_lock:
+        if pool_maxsize <= getattr(session, "pool_maxsize", 0):
+            return
+        adapter = _new_adapter(pool_maxsize)
+        old_adapters = session.adapters
+        adapters = OrderedDict(old_adapters)
+        adapters["https://"] = adapter
+        adapters["http://"] = adapter
+        session.adapters = adapters
+        session.pool_maxsize = pool_maxsize
+        for old in set(old_adapters.values()) - set(adapters.values()):
+            old.close()
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import re
+import time
+import threading
+from tosasitill_123pan import config
+from utils.ratelimit import TokenBucket
+
+UPLOAD = "upload"
+DOWNLOAD = "download"
+
+_RATE_UNITS = {"": 1, "B": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+
+def parse_rate(text):
+    """Parse a bandwidth like '512K', '2M', '1.5MB/s' or 'off' into bytes/sec
+
+    Args:
+        text: Rate string (a bare number is bytes/sec)
+
+    Returns:
+        int: Bytes per second, or None for unlimited ('off', 'none', '0')
+
+    Raises:
+        ValueError: If the text is not a valid rate
+    """
+    value = text.strip().upper()
+    if value in ("OFF", "NONE", "UNLIMITED", "0"):
+        return None
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)\s*([KMG]?)(?:I?B)?(?:/S)?", value)
+    if not match:
+        raise ValueError(f"Invalid rate '{text}' (examples: 512K, 2M, 1.5MB, off)")
+    rate = int(float(match.group(1)) * _RATE_UNITS[match.group(2)])
+    return rate or None
+
+
+def format_rate(rate):
+    """Format bytes/sec for display ('unlimited' for None)"""
+    if not rate:
+        return "unlimited"
+    for unit, size in (("GB", 1024 ** 3), ("MB", 1024 ** 2), ("KB", 1024)):
+        if rate >= size:
+            return f"{rate / size:.2f} {unit}/s"
+    return f"{rate} B/s"
+
+
+def _parse_clock(text):
+    hours, minutes = text.strip().split(":")
+    hours, minutes = int(hours), int(minutes)
+    if not (0 <= hours <= 24 and 0 <= minutes < 60):
+        raise ValueError(f"Invalid time '{text}'")
+    return hours * 60 + minutes
+
+
+class ScheduleRule:
+    """Bandwidth limits that apply during a daily time window
+
+    The window is [start, end) in local time and may wrap past midnight
+    (e.g. 22:00-06:00).
+    """
+
+    def __init__(self, start, end, upload=None, download=None):
+        """Initialize the rule
+
+        Args:
+            start: Window start as "HH:MM"
+            end: Window end as "HH:MM"
+            upload: Upload limit as bytes/sec or a rate string (None for unlimited)
+            download: Download limit as bytes/sec or a rate string (None for unlimited)
+        """
+        self.start = _parse_clock(start)
+        self.end = _parse_clock(end)
+        self.label = f"{start}-{end}"
+        self.rates = {
+            UPLOAD: parse_rate(upload) if isinstance(upload, str) else upload,
+            DOWNLOAD: parse_rate(download) if isinstance(download, str) else download,
+        }
+
+    def active(self, minute_of_day):
+        if self.start <= self.end:
+            return self.start <= minute_of_day < self.end
+        return minute_of_day >= self.start or minute_of_day < self.end
+
+
+class BandwidthLimiter:
+    """Process-wide upload and download bandwidth caps
+
+    One token bucket per direction, in bytes, shared by every thread that
+    transfers file data: part PUTs draw from the upload bucket and range GETs
+    from the download bucket. Limits can be changed at any time. Optional
+    schedule rules override the manual limits while their time window is
+    active; the schedule is re-evaluated at most every
+    BANDWIDTH_SCHEDULE_CHECK seconds.
+
+    When a direction is unlimited, throttle() returns without locking and
+    upload_body() hands back the body unchanged, so there is no per-chunk
+    cost.
+    """
+
+    def __init__(self):
+        self._buckets = {UPLOAD: TokenBucket(), DOWNLOAD: TokenBucket()}
+        self._manual = {UPLOAD: None, DOWNLOAD: None}
+        self._schedule = []
+        self._active_rule = None
+        self._next_check = 0.0
+        self._lock = threading.Lock()
+        self.set_schedule(ScheduleRule(*rule) for rule in config.BANDWIDTH_SCHEDULE)
+        self.set_limit(UPLOAD, config.BANDWIDTH_LIMIT_UP)
+        self.set_limit(DOWNLOAD, config.BANDWIDTH_LIMIT_DOWN)
+
+    def _apply(self, direction):
+        rule = self._active_rule
+        rate = rule.rates[direction] if rule is not None else self._manual[direction]
+        self._buckets[direction].set_rate(rate, self._burst(rate))
+
+    @staticmethod
+    def _burst(rate):
+        # Enough for a few socket writes, but small enough that the cap holds
+        # over short intervals
+        return max(rate * config.BANDWIDTH_BURST_SECONDS, 256 * 1024) if rate else None
+
+    def _check_schedule(self):
+        now = time.monotonic()
+        if now < self._next_check:
+            return
+        with self._lock:
+            if now < self._next_check:
+                return
+            self._next_check = now + config.BANDWIDTH_SCHEDULE_CHECK
+            local = time.localtime()
+            minute = local.tm_hour * 60 + local.tm_min
+            rule = next((r for r in self._schedule if r.active(minute)), None)
+            if rule is not self._active_rule:
+                self._active_rule = rule
+                self._apply(UPLOAD)
+                self._apply(DOWNLOAD)
+
+    def set_limit(self, direction, rate):
+        """Set the manual limit for one direction
+
+        Args:
+            direction: UPLOAD or DOWNLOAD
+            rate: Bytes per second (None for unlimited)
+        """
+        with self._lock:
+            self._manual[direction] = rate or None
+            self._apply(direction)
+
+    @property
+    def schedule(self):
+        """Current schedule rules (a copy)"""
+        with self._lock:
+            return list(self._schedule)
+
+    def set_schedule(self, rules):
+        """Replace the time-of-day schedule (an empty list removes it)
+
+        Args:
+            rules: Iterable of ScheduleRule; the first active rule wins
+        """
+        with self._lock:
+            self._schedule = list(rules)
+            self._active_rule = None
+            self._next_check = 0.0
+            self._apply(UPLOAD)
+            self._apply(DOWNLOAD)
+
+    def status(self):
+        """Describe the current limits and schedule
+
+        Returns:
+            list: Lines of text for display
+        """
+        if self._schedule:
+            self._check_schedule()
+        lines = []
+        for direction in (UPLOAD, DOWNLOAD):
+            current = self._buckets[direction].rate
+            manual = self._manual[direction]
+            line = f"{direction.capitalize()}: {format_rate(current)}"
+            if self._active_rule is not None:
+                line += f" (schedule {self._active_rule.label}; manual {format_rate(manual)})"
+            lines.append(line)
+        for rule in self._schedule:
+            lines.append(
+                f"Schedule {rule.label}: up {format_rate(rule.rates[UPLOAD])}, "
+                f"down {format_rate(rule.rates[DOWNLOAD])}"
+            )
+        return lines
+
+    def throttle(self, direction, num_bytes):
+        """Wait until num_bytes may be transferred in the given direction"""
+        if self._schedule:
+            self._check_schedule()
+        self._buckets[direction].acquire(num_bytes)
+
+    def limited(self, direction):
+        """Return True if the direction currently has a cap"""
+        if self._schedule:
+            self._check_schedule()
+        return self._buckets[direction].rate is not None
+
+    def upload_body(self, data):
+        """Wrap a request body so sending it draws from the upload bucket
+
+        Args:
+            data: Bytes-like body
+
+        Returns:
+            The body itself when uploads are unlimited, otherwise a
+            ThrottledBody reading from it
+        """
+        if not self.limited(UPLOAD):
+            return data
+        return ThrottledBody(data, self)
+
+
+class ThrottledBody:
+    """File-like request body that paces reads through the upload bucket
+
+    requests sends a body with read() and __len__ as a stream with a
+    Content-Length, so each block urllib3 reads waits for its tokens.
+    """
+
+    def __init__(self, data, limiter):
+        # Keep the caller's object (not a new memoryview of it), so a pooled
+        # or mapped view can still be released once the request is done
+        self._data = data
+        self._limiter = limiter
+        self._offset = 0
+
+    def __len__(self):
+        return len(self._data) - self._offset
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = len(self)
+        size = min(size, config.BANDWIDTH_CHUNK_SIZE, len(self))
+        if size <= 0:
+            return b""
+        self._limiter.throttle(UPLOAD, size)
+        chunk = bytes(self._data[self._offset:self._offset + size])
+        self._offset += size
+        return chunk
+
+
+# Shared by uploads and downloads in this process
+limiter = BandwidthLimiter()
@@ -8,6 +8,7 @@ import shlex
 from utils.input_handler import normalize_path
 from utils.mget import MGet, _validate_output_path
 from utils.logger import log_command, log_runtime, log_error
+from utils.bandwidth import limiter, parse_rate, ScheduleRule, UPLOAD, DOWNLOAD
 
 
 def create_argument_parser():
@@ -19,6 +20,10 @@ def create_argument_parser():
         -f, --force:    Force overwrite existing files
         -k, --keep:     Keep both files on conflict
         --no-skip:      Disable MD5 duplicate check
+        --part-workers: Concurrent part uploads within a single file
+        --rehash:       Ignore the local MD5 cache and re-hash every file
+        --mmap:         Read files through a memory map (zero-copy hashing and upload)
+        --auto-concurrency: Adapt the number of parallel part uploads to the network
         --qr, --qrcode: Force QR code login (scan with WeChat)
     
     Returns:
@@ -34,6 +39,10 @@ def create_argument_parser():
     parser.add_argument("-f", "--force", action="store_true", help="Overwrite existing files (delete and re-upload)")
     parser.add_argument("-k", "--keep", action="store_true", help="Keep both files on conflict")
     parser.add_argument("--no-skip", action="store_true", help="Don't skip existing files with same MD5")
+    parser.add_argument("--part-workers", type=int, help="Concurrent part uploads within a single file")
+    parser.add_argument("--rehash", action="store_true", help="Ignore the local MD5 cache and re-hash every file")
+    parser.add_argument("--mmap", action="store_true", help="Read files through a memory map (zero-copy hashing and upload)")
+    parser.add_argument("--auto-concurrency", action="store_true", help="Adapt the number of parallel part uploads to the network")
     parser.add_argument("--qr", "--qrcode", dest="qrcode", action="store_true", help="Force QR code login (scan with WeChat or 123Pan app)")
     
     return parser
@@ -80,6 +89,10 @@ def parse_upload_command(user_input, default_sure_option, default_skip_existing)
             - dest_name: Destination name (str or None)
             - sure_option: Conflict resolution option (str)
             - skip_existing: Whether to skip existing files (bool)
+            - part_workers: Per-file part concurrency (int or None)
+            - rehash: Whether to bypass the local MD5 cache (bool)
+            - use_mmap: Whether to read files through a memory map (bool)
+            - auto_concurrency: Whether to adapt part concurrency to the network (bool)
             - error: Error message if parsing failed (str or None)
     """
     result = {
@@ -87,6 +100,10 @@ def parse_upload_command(user_input, default_sure_option, default_skip_existing)
         'dest_name': None,
         'sure_option': default_sure_option,
         'skip_existing': default_skip_existing,
+        'part_workers': None,
+        'rehash': False,
+        'use_mmap': False,
+        'auto_concurrency': False,
         'error': None
     }
 
@@ -115,9 +132,9 @@ def parse_upload_command(user_input, default_sure_option, default_skip_existing)
             break
 
     # Flags that take a value (must be followed by a non-flag argument)
-    flags_with_value = {'-d', '--dest'}
+    flags_with_value = {'-d', '--dest', '--part-workers'}
     # Boolean flags (don't consume additional values)
-    bool_flags = {'-f', '--force', '-k', '--keep', '--no-skip', '--qr', '--qrcode'}
+    bool_flags = {'-f', '--force', '-k', '--keep', '--no-skip', '--rehash', '--mmap', '--auto-concurrency', '--qr', '--qrcode'}
 
     path_parts = []
     i = 0
@@ -178,7 +195,7 @@ def parse_upload_command(user_input, default_sure_option, default_skip_existing)
         parser = create_argument_parser()
         parsed_args = parser.parse_args(parts[len(path_parts):])
     except SystemExit:
-        result['error'] = "Invalid flags. Use: <path> [-d dest] [-f | -k] [--no-skip]"
+        result['error'] = "Invalid flags. Use: <path> [-d dest] [-f | -k] [--no-skip] [--rehash] [--mmap] [--auto-concurrency] [--part-workers n]"
         return result
 
     result['path'] = normalize_path(raw_path)
@@ -190,6 +207,14 @@ def parse_upload_command(user_input, default_sure_option, default_skip_existing)
         result['sure_option'] = "1"
 
     result['skip_existing'] = not parsed_args.no_skip
+    result['rehash'] = parsed_args.rehash
+    result['use_mmap'] = parsed_args.mmap
+    result['auto_concurrency'] = parsed_args.auto_concurrency
+    if parsed_args.part_workers is not None:
+        if parsed_args.part_workers < 1:
+            result['error'] = "--part-workers must be at least 1"
+            return result
+        result['part_workers'] = parsed_args.part_workers
     return result
 
 
@@ -203,7 +228,7 @@ def handle_mget_command(user_input):
         user_input: Raw command input starting with 'mget'
 
     Usage:
-        mget <url> [-o output_file] [-t threads] [-s]
+        mget <url> [-o output_file] [-t threads] [-s] [-a] [--md5 hash]
     """
     import shlex
     import argparse
@@ -219,10 +244,12 @@ def handle_mget_command(user_input):
         args = parts[1:] if len(parts) > 1 else []
         
         if not args:
-            print("Usage: mget <url> [-o output_file] [-t threads] [-s]")
+            print("Usage: mget <url> [-o output_file] [-t threads] [-s] [-a] [--md5 hash]")
             print("  -o: Output filename (default: 'downloaded_file')")
             print("  -t: Number of threads (default: 8)")
             print("  -s: Use single-threaded download")
+            print("  -a: Adapt the thread count to the network (-t is the starting point)")
+            print("  --md5: Verify the download against this MD5 (retried once on mismatch)")
             return
         
         # Create parser for mget arguments
@@ -234,6 +261,8 @@ def handle_mget_command(user_input):
         parser.add_argument("-o", "--output", help="Output file path", default="downloaded_file")
         parser.add_argument("-t", "--threads", type=int, help="Number of threads", default=8)
         parser.add_argument("-s", "--single", action="store_true", help="Use single-threaded download")
+        parser.add_argument("-a", "--auto-concurrency", action="store_true", help="Adapt the thread count to the network")
+        parser.add_argument("--md5", help="Expected MD5 of the file")
         
         try:
             parsed_args = parser.parse_args(args)
@@ -256,10 +285,14 @@ def handle_mget_command(user_input):
         print(f"Starting download: {url}")
         print(f"Saving to: {validated_output}")
         print(f"Threads: {'1 (single)' if single_thread else threads}")
+        if parsed_args.auto_concurrency and not single_thread:
+            print("Adaptive thread count: on")
 
-        downloader = MGet(default_threads=threads)
+        downloader = MGet(default_threads=threads, auto_concurrency=parsed_args.auto_concurrency)
         # Pass validated path directly; MGet.download skips its own validation
-        result = downloader._download_raw(url, validated_output, threads, force_single=single_thread)
+        result = downloader._download_raw(
+            url, validated_output, threads, force_single=single_thread, expected_md5=parsed_args.md5
+        )
         
         # Show completion message
         if result is not None and os.path.exists(validated_output):
@@ -272,7 +305,64 @@ def handle_mget_command(user_input):
         print(f"Download failed: {str(e)}")
 
 
-def execute_upload(mpush, path, sure_option, dest_name, skip_existing):
+def handle_limit_command(user_input):
+    """Handle the limit (bandwidth) command.
+
+    New limits apply from the next transfer (transfers run in the
+    foreground, so none is running while a command is typed); schedule
+    rules also switch over during a running transfer.
+
+    Args:
+        user_input: Raw command input starting with 'limit'
+
+    Usage:
+        limit                                   Show current limits
+        limit up <rate|off>                     Cap upload speed (e.g. 2M, 512K)
+        limit down <rate|off>                   Cap download speed
+        limit off                               Remove both manual limits
+        limit schedule HH:MM-HH:MM <up> <down>  Add a time-of-day rule
+        limit schedule clear                    Remove all schedule rules
+    """
+    parts = user_input.split()[1:]
+    usage = ("Usage: limit [up <rate|off>] [down <rate|off>] | limit off | "
+             "limit schedule HH:MM-HH:MM <up> <down> | limit schedule clear")
+
+    try:
+        if not parts:
+            pass
+        elif parts == ['off']:
+            limiter.set_limit(UPLOAD, None)
+            limiter.set_limit(DOWNLOAD, None)
+        elif parts[0] == 'schedule':
+            if parts[1:] == ['clear']:
+                limiter.set_schedule([])
+            elif len(parts) == 4 and '-' in parts[1]:
+                start, end = parts[1].split('-', 1)
+                rule = ScheduleRule(start, end, parts[2], parts[3])
+                limiter.set_schedule(limiter.schedule + [rule])
+            else:
+                print(usage)
+                return
+        elif len(parts) % 2 == 0 and all(p in ('up', 'down') for p in parts[::2]):
+            # Parse everything first so a bad value changes nothing
+            rates = [(UPLOAD if d == 'up' else DOWNLOAD, parse_rate(r)) for d, r in zip(parts[::2], parts[1::2])]
+            for direction, rate in rates:
+                limiter.set_limit(direction, rate)
+        else:
+            print(usage)
+            return
+    except ValueError as e:
+        print(f"Invalid limit: {e}")
+        return
+
+    if parts:
+        log_runtime(f"Bandwidth limits changed: {' '.join(parts)}")
+    for line in limiter.status():
+        print(line)
+
+
+def execute_upload(mpush, path, sure_option, dest_name, skip_existing, part_workers=None, rehash=False,
+                   use_mmap=False, auto_concurrency=False):
     """Execute the upload operation for a file or directory.
     
     Logs the upload start and completion to the runtime log.
@@ -283,9 +373,32 @@ def execute_upload(mpush, path, sure_option, dest_name, skip_existing):
         sure_option: Conflict resolution option ("1" for keep both, "2" for overwrite)
         dest_name: Destination name (None to keep original)
         skip_existing: Whether to skip files with matching MD5
+        part_workers: Per-file part concurrency for this upload only (None keeps mpush's setting)
+        rehash: If True, ignore cached MD5s for this upload
+        use_mmap: If True, hash and upload through memory maps for this upload
+        auto_concurrency: If True, adapt part upload concurrency for this upload
     """
     log_runtime(f"Upload started: path='{path}', mode={sure_option}, dest='{dest_name}', skip={skip_existing}")
-    
+
+    previous_part_workers = mpush.part_workers
+    if part_workers:
+        mpush.part_workers = part_workers
+    mpush.rehash = rehash
+    mpush.use_mmap = use_mmap
+    mpush.set_auto_concurrency(auto_concurrency)
+    mpush.reset_retry_budget()
+    try:
+        _execute_upload(mpush, path, sure_option, dest_name, skip_existing)
+    finally:
+        mpush.part_workers = previous_part_workers
+        mpush.rehash = False
+        mpush.use_mmap = False
+        mpush.set_auto_concurrency(False)
+        mpush.hash_cache.flush()
+
+
+def _execute_upload(mpush, path, sure_option, dest_name, skip_existing):
+    """Dispatch a file or directory upload (see execute_upload)"""
     if os.path.isdir(path):
         # Upload directory
         print(f"Preparing to upload directory: {os.path.basename(path)}")
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+from tosasitill_123pan import config
+
+
+class AdaptiveConcurrency:
+    """AIMD controller for the number of concurrent transfers
+
+    Works like a semaphore whose size changes with network feedback. Each
+    transfer takes a slot with acquire() and returns it with release(),
+    reporting the bytes it moved and whether it hit a congestion signal
+    (timeout, 429/503, ban). Completed transfers are grouped into windows of
+    at least AUTO_CONCURRENCY_INTERVAL seconds and `limit` transfers; after
+    each window the limit is adjusted:
+
+    - congestion: multiplicative decrease (x AUTO_CONCURRENCY_BACKOFF),
+      applied immediately and at most once per burst of failures
+    - aggregate throughput up by more than AUTO_CONCURRENCY_GAIN while every
+      slot was busy: additive increase (+1)
+    - throughput flat but time per byte up by AUTO_CONCURRENCY_LATENCY_RISE
+      over the best seen: -1 (extra transfers only queue)
+    - otherwise hold, probing +1 again every AUTO_CONCURRENCY_PROBE_WINDOWS
+
+    Thread-safe.
+    """
+
+    def __init__(self, initial=None, minimum=None, maximum=None):
+        """Initialize the controller
+
+        Args:
+            initial: Starting limit (default: config.AUTO_CONCURRENCY_INITIAL)
+            minimum: Lowest limit (default: config.AUTO_CONCURRENCY_MIN)
+            maximum: Highest limit (default: config.AUTO_CONCURRENCY_MAX)
+        """
+        self.minimum = minimum or config.AUTO_CONCURRENCY_MIN
+        self.maximum = maximum or config.AUTO_CONCURRENCY_MAX
+        self.limit = min(max(initial or config.AUTO_CONCURRENCY_INITIAL, self.minimum), self.maximum)
+
+        self._cond = threading.Condition()
+        self._in_use = 0
+        self._peak = 0                 # most slots in use during this window
+        self._last_decrease = 0.0      # transfers started before this don't trigger another decrease
+        self._last_rate = None         # throughput of the previous window
+        self._best_latency = None      # lowest seconds per byte seen
+        self._plateau = 0              # consecutive windows without change
+        self._reset_window(time.monotonic())
+
+    def _reset_window(self, now):
+        self._window_start = now
+        self._window_bytes = 0
+        self._window_ops = 0
+        self._window_busy = 0.0
+        self._peak = self._in_use
+
+    def acquire(self):
+        """Wait for a free slot
+
+        Returns:
+            float: Start time to pass back to release()
+        """
+        with self._cond:
+            while self._in_use >= self.limit:
+                self._cond.wait()
+            self._in_use += 1
+            self._peak = max(self._peak, self._in_use)
+        return time.monotonic()
+
+    def add_bytes(self, num_bytes):
+        """Count bytes of a transfer that is still running (for long streams)"""
+        with self._cond:
+            self._window_bytes += num_bytes
+
+    def release(self, started, num_bytes=0, congested=False):
+        """Return a slot and report how the transfer went
+
+        Args:
+            started: Value returned by acquire()
+            num_bytes: Bytes transferred and not already passed to add_bytes()
+            congested: True if the transfer hit a congestion signal
+        """
+        now = time.monotonic()
+        with self._cond:
+            self._in_use -= 1
+            if congested:
+                if started >= self._last_decrease:
+                    self._set_limit(max(self.minimum, int(self.limit * config.AUTO_CONCURRENCY_BACKOFF)))
+                    self._last_decrease = now
+                    self._last_rate = None
+                    self._reset_window(now)
+            else:
+                self._window_bytes += num_bytes
+                self._window_ops += 1
+                self._window_busy += now - started
+                elapsed = now - self._window_start
+                if elapsed >= config.AUTO_CONCURRENCY_INTERVAL and self._window_ops >= self.limit:
+                    self._end_window(now, elapsed)
+            self._cond.notify_all()
+
+    def _end_window(self, now, elapsed):
+        rate = self._window_bytes / elapsed
+        latency = self._window_busy / self._window_bytes if self._window_bytes else None
+        saturated = self._peak >= self.limit
+        improved = self._last_rate is None or rate > self._last_rate * (1 + config.AUTO_CONCURRENCY_GAIN)
+
+        if latency is not None and (self._best_latency is None or latency < self._best_latency):
+            self._best_latency = latency
+
+        if improved and saturated:
+            self._set_limit(min(self.maximum, self.limit + 1))
+        elif (not improved and latency is not None
+              and latency > self._best_latency * config.AUTO_CONCURRENCY_LATENCY_RISE):
+            self._set_limit(max(self.minimum, self.limit - 1))
+        else:
+            self._plateau += 1
+            if saturated and self._plateau >= config.AUTO_CONCURRENCY_PROBE_WINDOWS:
+                self._set_limit(min(self.maximum, self.limit + 1))
+
+        self._last_rate = rate
+        self._reset_window(now)
+
+    def _set_limit(self, limit):
+        self._plateau = 0
+        self.limit = limit
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Sidecar state of resumable downloads
+
+While a download into `output` runs, `output.mget-state` next to it records
+the identity of the remote file (size, ETag, Last-Modified), the byte
+ranges the download was split into and how many bytes of each range have
+been written. Running the same download again, even through a freshly
+resolved link, then fetches only the missing bytes, provided the remote
+file still has the same identity. The sidecar is removed once the download
+completes.
+
+Progress is only recorded after the bytes were written to the output file,
+so the state may lag behind the file but never runs ahead of it.
+"""
+
+import os
+import json
+import time
+import threading
+from tosasitill_123pan import config
+
+STATE_SUFFIX = ".mget-state"
+
+
+class DownloadState:
+    """Thread-safe progress record of one download
+
+    Writes are coalesced: progress is flushed at most every
+    config.DOWNLOAD_STATE_FLUSH_INTERVAL seconds and whenever flush() is
+    called (on failure or interruption).
+    """
+
+    def __init__(self, output_path, identity, ranges):
+        """Initialize the state
+
+        Args:
+            output_path: Path to the output file
+            identity: Remote file identity from identity_of()
+            ranges: List of [start, end, done] lists (end inclusive, done in bytes)
+        """
+        self.state_path = output_path + STATE_SUFFIX
+        self.identity = identity
+        self.ranges = ranges
+        # Without validators a changed remote file can't be detected, so the
+        # progress is tracked in memory only and no sidecar is written
+        self.persist = self.resumable(identity)
+        self._lock = threading.Lock()
+        self._dirty = True
+        self._last_flush = 0.0
+
+    @staticmethod
+    def identity_of(headers):
+        """Build a remote file identity from full-content response headers
+
+        Args:
+            headers: Headers of a HEAD or 200 GET response
+
+        Returns:
+            dict: 'size', 'etag' and 'lastModified' keys
+        """
+        return {
+            "size": int(headers.get("content-length", 0)),
+            "etag": headers.get("ETag"),
+            "lastModified": headers.get("Last-Modified"),
+        }
+
+    @staticmethod
+    def resumable(identity):
+        """Return True if a download with this identity can be resumed safely
+
+        Without a size and an ETag or Last-Modified header a changed remote
+        file could not be told apart, so such downloads are not resumed.
+        """
+        return bool(identity["size"] and (identity["etag"] or identity["lastModified"]))
+
+    @staticmethod
+    def pending(output_path):
+        """Return True if a sidecar state exists for output_path"""
+        return os.path.exists(output_path + STATE_SUFFIX)
+
+    @classmethod
+    def resume(cls, output_path, identity):
+        """Load saved progress if it belongs to the same remote file
+
+        Args:
+            output_path: Path to the output file
+            identity: Identity of the remote file as it is now
+
+        Returns:
+            DownloadState or None if there is nothing to resume
+        """
+        state_path = output_path + STATE_SUFFIX
+        try:
+            with open(state_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            print(f"Warning: Ignoring unreadable download state {state_path}: {e}")
+            return None
+
+        if data.get("identity") != identity:
+            print("Remote file changed since the partial download, starting over")
+            return None
+        if not cls.resumable(identity):
+            return None
+        try:
+            file_size = os.path.getsize(output_path)
+        except OSError:
+            return None
+        ranges = data.get("ranges")
+        if not isinstance(ranges, list) or not all(
+                isinstance(r, list) and len(r) == 3 and 0 <= r[2] <= r[1] - r[0] + 1 for r in ranges):
+            return None
+        # A single-thread download grows the file as it goes; any other
+        # size means the file was changed since the state was written
+        if file_size > identity["size"] or any(start + done > file_size for start, _, done in ranges):
+            return None
+
+        state = cls(output_path, identity, ranges)
+        state._dirty = False
+        return state
+
+    @property
+    def done_bytes(self):
+        """Bytes already written to the output file"""
+        with self._lock:
+            return sum(done for _, _, done in self.ranges)
+
+    def remaining(self):
+        """List the unfinished ranges
+
+        Returns:
+            list: (index, start, end) tuples of the bytes still missing
+        """
+        with self._lock:
+            return [
+                (i, start + done, end)
+                for i, (start, end, done) in enumerate(self.ranges)
+                if start + done <= end
+            ]
+
+    def split(self, index, mid):
+        """Cut a range in two; the bytes from mid on become a new range
+
+        Args:
+            index: Index of the range to cut
+            mid: First byte of the new range (past the bytes already written)
+
+        Returns:
+            int: Index of the new range
+        """
+        with self._lock:
+            end = self.ranges[index][1]
+            self.ranges[index][1] = mid - 1
+            self.ranges.append([mid, end, 0])
+            self._dirty = True
+            return len(self.ranges) - 1
+
+    def advance(self, index, num_bytes):
+        """Record bytes written for a range (flushed lazily)"""
+        with self._lock:
+            self.ranges[index][2] += num_bytes
+            self._dirty = True
+            due = time.monotonic() - self._last_flush >= config.DOWNLOAD_STATE_FLUSH_INTERVAL
+        if due:
+            self.flush()
+
+    def flush(self):
+        """Write the state to disk atomically if it changed"""
+        with self._lock:
+            if not self._dirty or not self.persist:
+                return
+            data = json.dumps({"identity": self.identity, "ranges": self.ranges})
+            self._dirty = False
+            self._last_flush = time.monotonic()
+            tmp_path = f"{self.state_path}.tmp"
+            try:
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    f.write(data)
+                os.replace(tmp_path, self.state_path)
+            except OSError as e:
+                self._dirty = True
+                print(f"Warning: Failed to write download state: {e}")
+
+    def remove(self):
+        """Delete the sidecar (download finished)"""
+        with self._lock:
+            self._dirty = False
+            try:
+                os.remove(self.state_path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f"Warning: Failed to remove download state {self.state_path}: {e}")
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import mmap
+import queue
+import hashlib
+import threading
+from contextlib import contextmanager
+from tosasitill_123pan import config
+
+
+def read_exactly(f, view):
+    """Fill a writable memoryview from a binary file with readinto()
+
+    Args:
+        f: File object opened in binary mode, positioned at the data
+        view: Writable memoryview to fill
+
+    Returns:
+        int: Number of bytes read (less than len(view) only at end of file)
+    """
+    filled = 0
+    while filled < len(view):
+        n = f.readinto(view[filled:])
+        if not n:
+            break
+        filled += n
+    return filled
+
+
+class BufferPool:
+    """Fixed number of reusable byte buffers for part data
+
+    Part workers borrow a buffer, fill it with readinto() and hand the HTTP
+    layer a memoryview of it, so no new bytes object is allocated per part.
+    borrow() blocks while every buffer is in use, which caps memory held for
+    part data at (count x largest part size) no matter how many files or
+    part workers are active, and holds back workers when uploads lag behind.
+
+    Buffers start empty and are reallocated only when a larger part is
+    requested than the buffer holds. Thread-safe.
+    """
+
+    def __init__(self, count=None):
+        """Initialize the pool
+
+        Args:
+            count: Number of buffers (default: config.PART_BUFFER_COUNT)
+        """
+        self.count = count or config.PART_BUFFER_COUNT
+        self._free = queue.LifoQueue()  # LIFO so recently used (large, warm) buffers come back first
+        for _ in range(self.count):
+            self._free.put(bytearray())
+
+    @contextmanager
+    def borrow(self, size):
+        """Borrow a buffer of at least `size` bytes
+
+        Args:
+            size: Bytes needed
+
+        Yields:
+            memoryview: Writable view of exactly `size` bytes, valid inside the block
+        """
+        buffer = self._free.get()
+        try:
+            if len(buffer) < size:
+                buffer = bytearray(size)
+            with memoryview(buffer) as whole, whole[:size] as view:
+                yield view
+        finally:
+            self._free.put(buffer)
+
+
+class MappedFile:
+    """Read-only memory map of a file, served as zero-copy memoryview slices
+
+    Used by the optional mmap read path: the MD5 is computed directly over
+    the mapping and part bodies are slices of it, so file data is never
+    copied into Python buffers and a second pass over the file is served
+    straight from the page cache. The kernel is told the file will be read
+    sequentially where madvise() is available.
+
+    The file must not be truncated while mapped (reading past the new end
+    raises SIGBUS on POSIX), which is why this path is opt-in.
+    """
+
+    def __init__(self, file_path):
+        """Map a file
+
+        Args:
+            file_path: Path to the file
+        """
+        self._mmap = None
+        with open(file_path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size:
+                # The mapping stays valid after the file object is closed
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap is not None:
+            if hasattr(self._mmap, "madvise") and hasattr(mmap, "MADV_SEQUENTIAL"):
+                self._mmap.madvise(mmap.MADV_SEQUENTIAL)
+            self._view = memoryview(self._mmap)
+        else:
+            self._view = memoryview(b"")  # mmap cannot map empty files
+        self.size = len(self._view)
+
+    def slice(self, offset, length):
+        """Return a zero-copy view of part of the file
+
+        Release it (or use it as a context manager) when done, so the
+        mapping can be closed.
+
+        Args:
+            offset: Byte offset
+            length: Number of bytes
+
+        Returns:
+            memoryview: Read-only view of the requested bytes
+        """
+        return self._view[offset:offset + length]
+
+    def md5(self, chunk_size=None):
+        """Hash the whole file over the mapping
+
+        Args:
+            chunk_size: Bytes per hashlib update (default: config.HASH_READ_SIZE)
+
+        Returns:
+            str: Hexadecimal MD5 hash string
+        """
+        chunk_size = chunk_size or config.HASH_READ_SIZE
+        md5 = hashlib.md5()
+        for offset in range(0, self.size, chunk_size):
+            with self.slice(offset, chunk_size) as chunk:
+                md5.update(chunk)
+        return md5.hexdigest()
+
+    def close(self):
+        """Unmap the file
+
+        If a slice is still referenced elsewhere (e.g. by a finished request
+        object), the mapping is left for the garbage collector to unmap.
+        """
+        try:
+            self._view.release()
+            if self._mmap is not None:
+                self._mmap.close()
+        except BufferError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class PreallocatedFile:
+    """Output file that parallel range downloads write in place
+
+    The file is sized up front (and its blocks reserved with
+    posix_fallocate() where available), then each range worker writes at
+    its own offset with os.pwrite(), so no per-range part files are
+    written and merged afterwards. Existing contents are kept, except
+    past `size`. Platforms without pwrite()/pread() (Windows) fall back to
+    a locked seek and write or read. Thread-safe.
+    """
+
+    def __init__(self, file_path, size):
+        """Open (or create) and size the file
+
+        Args:
+            file_path: Path to the output file
+            size: Final file size in bytes
+        """
+        self.size = size
+        self._lock = threading.Lock()
+        self._fd = os.open(file_path, os.O_RDWR | os.O_CREAT | getattr(os, "O_BINARY", 0), 0o666)
+        try:
+            os.ftruncate(self._fd, size)
+            if size and hasattr(os, "posix_fallocate"):
+                try:
+                    os.posix_fallocate(self._fd, 0, size)
+                except OSError:
+                    pass  # Not supported by this filesystem; the file is sparse instead
+        except OSError:
+            os.close(self._fd)
+            raise
+
+    def write_at(self, offset, data):
+        """Write all of data at a byte offset
+
+        Args:
+            offset: Byte offset in the file
+            data: Bytes-like object to write
+        """
+        with memoryview(data) as view:
+            if hasattr(os, "pwrite"):
+                while view:
+                    written = os.pwrite(self._fd, view, offset)
+                    view = view[written:]
+                    offset += written
+            else:
+                with self._lock:
+                    os.lseek(self._fd, offset, os.SEEK_SET)
+                    while view:
+                        view = view[os.write(self._fd, view):]
+
+    def read_at(self, offset, length):
+        """Read bytes back from a byte offset
+
+        Args:
+            offset: Byte offset in the file
+            length: Number of bytes
+
+        Returns:
+            bytes: The data (shorter only at end of file)
+        """
+        if hasattr(os, "pread"):
+            pieces = []
+            while length > 0:
+                piece = os.pread(self._fd, length, offset)
+                if not piece:
+                    break
+                pieces.append(piece)
+                offset += len(piece)
+                length -= len(piece)
+            return b"".join(pieces)
+        with self._lock:
+            os.lseek(self._fd, offset, os.SEEK_SET)
+            pieces = []
+            while length > 0:
+                piece = os.read(self._fd, length)
+                if not piece:
+                    break
+                pieces.append(piece)
+                length -= len(piece)
+            return b"".join(pieces)
+
+    def close(self):
+        """Close the file"""
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
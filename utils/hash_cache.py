@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Persistent MD5 cache for local files
+
+Stores the MD5 of every hashed file in a small SQLite database keyed by
+(device, inode, size, mtime_ns). A file whose stat() still matches its
+cached entry is not read again, so re-uploading an unchanged tree costs a
+stat() per file instead of a full hash pass.
+
+Entries whose file changed are replaced on the next lookup, and entries that
+have not been used for HASH_CACHE_MAX_AGE_DAYS are evicted when the cache is
+opened.
+
+Several instances may share the database: it runs in WAL mode, so readers
+never block, and writes are collected in memory and committed in short
+batches, so no instance holds the write lock for long.
+"""
+
+import os
+import time
+import atexit
+import threading
+from tosasitill_123pan import config
+
+try:
+    import sqlite3
+    _sqlite_available = True
+except ImportError:
+    sqlite3 = None
+    _sqlite_available = False
+
+# Write after this many pending changes (also written on flush and close)
+_COMMIT_EVERY = 256
+
+# Refresh an entry's last_used on a hit only once it is this old (seconds)
+_TOUCH_AFTER = 86400
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS file_md5 (
+    device    INTEGER NOT NULL,
+    inode     INTEGER NOT NULL,
+    size      INTEGER NOT NULL,
+    mtime_ns  INTEGER NOT NULL,
+    md5       TEXT NOT NULL,
+    path      TEXT NOT NULL,
+    last_used REAL NOT NULL,
+    PRIMARY KEY (device, inode)
+)
+"""
+
+
+class HashCache:
+    """Thread-safe on-disk cache of file MD5 hashes
+
+    If SQLite is unavailable or the database cannot be opened, the cache
+    stays disabled and every lookup misses.
+    """
+
+    def __init__(self, db_path=None, max_age_days=None):
+        """Open (or create) the cache database
+
+        Args:
+            db_path: Path to the SQLite file (default: config.HASH_CACHE_FILE)
+            max_age_days: Evict entries unused for this many days
+                (default: config.HASH_CACHE_MAX_AGE_DAYS)
+        """
+        self.db_path = os.path.expanduser(db_path or config.HASH_CACHE_FILE)
+        self.max_age_days = max_age_days or config.HASH_CACHE_MAX_AGE_DAYS
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._pending = {}  # (device, inode) -> row to write, or None to delete
+        self._conn = None
+
+        if not _sqlite_available:
+            return
+        try:
+            self._conn = sqlite3.connect(
+                self.db_path, timeout=config.HASH_CACHE_TIMEOUT, check_same_thread=False
+            )
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(_SCHEMA)
+            self._conn.execute(
+                "DELETE FROM file_md5 WHERE last_used < ?",
+                (time.time() - self.max_age_days * 86400,)
+            )
+            self._conn.commit()
+        except sqlite3.Error as e:
+            print(f"Warning: MD5 cache disabled ({self.db_path}): {e}")
+            self._conn = None
+            return
+
+        # Pending writes are batched; make sure they reach disk on exit
+        atexit.register(self.close)
+
+    @property
+    def enabled(self):
+        return self._conn is not None
+
+    def _queue(self, key, row):
+        self._pending[key] = row
+        if len(self._pending) >= _COMMIT_EVERY:
+            self._write_pending()
+
+    def _write_pending(self):
+        # One short transaction per batch; caller holds self._lock
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        try:
+            with self._conn:
+                self._conn.executemany(
+                    "DELETE FROM file_md5 WHERE device = ? AND inode = ?",
+                    [key for key, row in pending.items() if row is None]
+                )
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO file_md5 "
+                    "(device, inode, size, mtime_ns, md5, path, last_used) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [key + row for key, row in pending.items() if row is not None]
+                )
+        except sqlite3.Error:
+            pass
+
+    def get(self, file_stat):
+        """Look up the cached MD5 for a file
+
+        Args:
+            file_stat: os.stat_result of the file
+
+        Returns:
+            str: Cached MD5 if the file is unchanged since it was hashed, else None
+        """
+        if self._conn is None:
+            return None
+        key = (file_stat.st_dev, file_stat.st_ino)
+        with self._lock:
+            if key in self._pending:
+                row = self._pending[key]
+            else:
+                try:
+                    row = self._conn.execute(
+                        "SELECT size, mtime_ns, md5, path, last_used FROM file_md5 "
+                        "WHERE device = ? AND inode = ?", key
+                    ).fetchone()
+                except sqlite3.Error:
+                    row = None
+            if row is None:
+                self.misses += 1
+                return None
+            if row[0] != file_stat.st_size or row[1] != file_stat.st_mtime_ns:
+                # File changed since it was hashed: evict the stale entry
+                self._queue(key, None)
+                self.misses += 1
+                return None
+            now = time.time()
+            if now - row[4] > _TOUCH_AFTER:
+                self._queue(key, row[:4] + (now,))
+        self.hits += 1
+        return row[2]
+
+    def put(self, file_path, file_stat, md5):
+        """Store the MD5 of a file
+
+        Args:
+            file_path: Path of the file (kept for reference only)
+            file_stat: os.stat_result taken before the file was hashed
+            md5: Hexadecimal MD5 hash string
+        """
+        if self._conn is None:
+            return
+        with self._lock:
+            self._queue(
+                (file_stat.st_dev, file_stat.st_ino),
+                (file_stat.st_size, file_stat.st_mtime_ns, md5, os.path.abspath(file_path), time.time())
+            )
+
+    def flush(self):
+        """Write pending changes to disk"""
+        if self._conn is None:
+            return
+        with self._lock:
+            self._write_pending()
+
+    def close(self):
+        """Write pending changes and close the database"""
+        if self._conn is None:
+            return
+        self.flush()
+        with self._lock:
+            self._conn.close()
+            self._conn = None
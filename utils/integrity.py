@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+import hashlib
+import threading
+from tosasitill_123pan import config
+
+
+def normalize_md5(value):
+    """Normalize an MD5 given as an ETag or hex string
+
+    Args:
+        value: MD5 hex string, possibly quoted (e.g. '"d41d8cd9..."')
+
+    Returns:
+        str: Lowercase hex MD5, or None if value is not an MD5
+    """
+    if not value:
+        return None
+    value = value.strip().strip('"').lower()
+    if len(value) != 32 or any(c not in "0123456789abcdef" for c in value):
+        return None
+    return value
+
+
+class StreamingMD5:
+    """MD5 of a file computed while its ranges are written out of order
+
+    Writers report every write with update(). An ordered cursor hashes the
+    bytes as soon as everything before them has been hashed, so no second
+    pass over the finished file is needed. Writes that land ahead of the
+    cursor are held in memory up to buffer_limit bytes; a writer that would
+    exceed it waits for the cursor to catch up. Only if it waits longer
+    than config.DOWNLOAD_VERIFY_WAIT, or after release(), is just the
+    position remembered and the bytes read back from the file (usually
+    still in the page cache) once the cursor gets there.
+
+    Hashing runs on whichever writer filled the gap at the cursor, one
+    thread at a time; the others only queue their data. Thread-safe.
+    """
+
+    def __init__(self, size, read_at=None, written=(), buffer_limit=None):
+        """Initialize the hasher
+
+        Args:
+            size: File size in bytes
+            read_at: Callable (offset, length) -> bytes reading the file back;
+                needed unless every write arrives in order
+            written: (offset, length) pairs already in the file before
+                hashing started (the part of a resumed download done earlier)
+            buffer_limit: Bytes held ahead of the cursor (default: config.DOWNLOAD_VERIFY_BUFFER)
+        """
+        self.size = size
+        self._read_at = read_at
+        self._limit = buffer_limit or config.DOWNLOAD_VERIFY_BUFFER
+        self._md5 = hashlib.md5()
+        self._cursor = 0
+        self._pieces = {}      # offset -> bytes held in memory, or length of bytes to read back
+        self._buffered = 0
+        self._draining = False
+        self._waiting = True
+        self._lock = threading.Lock()
+        self._moved = threading.Condition(self._lock)
+        for offset, length in written:
+            if length:
+                self._pieces[offset] = length
+
+    def update(self, offset, data):
+        """Report bytes just written to the file
+
+        Args:
+            offset: Byte offset they were written at
+            data: The bytes (kept by reference while ahead of the cursor)
+        """
+        with self._lock:
+            deadline = time.monotonic() + config.DOWNLOAD_VERIFY_WAIT
+            while self._waiting and offset != self._cursor and self._buffered + len(data) > self._limit:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                self._moved.wait(timeout)
+            if offset != self._cursor and self._buffered + len(data) > self._limit:
+                self._pieces[offset] = len(data)
+            else:
+                self._pieces[offset] = data
+                self._buffered += len(data)
+            if self._draining or self._cursor not in self._pieces:
+                return
+            self._draining = True
+        self._drain()
+
+    def _drain(self):
+        try:
+            while True:
+                with self._lock:
+                    offset = self._cursor
+                    piece = self._pieces.pop(offset, None)
+                    if piece is None:
+                        self._draining = False
+                        return
+                    if not isinstance(piece, int):
+                        self._buffered -= len(piece)
+
+                if isinstance(piece, int):
+                    end = offset + piece
+                    for position in range(offset, end, config.HASH_READ_SIZE):
+                        self._md5.update(self._read_at(position, min(config.HASH_READ_SIZE, end - position)))
+                    length = piece
+                else:
+                    self._md5.update(piece)
+                    length = len(piece)
+
+                with self._lock:
+                    self._cursor = offset + length
+                    self._moved.notify_all()
+        except BaseException:
+            with self._lock:
+                self._draining = False
+            raise
+
+    def release(self):
+        """Stop holding writers back (a writer failed, so the cursor may never catch up)"""
+        with self._lock:
+            self._waiting = False
+            self._moved.notify_all()
+
+    def hexdigest(self):
+        """Hash whatever is left once all writes are done
+
+        Returns:
+            str: Hexadecimal MD5, or None if some bytes were never written
+        """
+        with self._lock:
+            if self._draining:
+                return None
+            self._draining = True
+        self._drain()
+        return self._md5.hexdigest() if self._cursor == self.size else None
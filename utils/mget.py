@@ -5,9 +5,17 @@ import argparse
 import os
 import time
 import requests
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, wait
 from tqdm import tqdm
 from tosasitill_123pan import config
+from tosasitill_123pan.session import create_session, ensure_pool_size
+from utils.bandwidth import limiter, DOWNLOAD
+from utils.concurrency import AdaptiveConcurrency
+from utils.retry import backoff_delay
+from utils.fileio import PreallocatedFile
+from utils.download_state import DownloadState
+from utils.range_scheduler import RangeScheduler
+from utils.integrity import StreamingMD5, normalize_md5
 
 
 def _validate_output_path(output_path):
@@ -36,7 +44,9 @@ def _validate_output_path(output_path):
     if parent_dir and not os.path.exists(parent_dir):
         raise ValueError(f"Output directory '{parent_dir}' does not exist. Please create it first or use a different path.")
 
-    if os.path.exists(normalized):
+    if os.path.exists(normalized) and DownloadState.pending(normalized):
+        print(f"Found a partial download of '{normalized}', it will be resumed if the remote file is unchanged")
+    elif os.path.exists(normalized):
         response = input(f"File '{normalized}' already exists. Overwrite? (y/N): ").strip().lower()
         if response != 'y':
             raise ValueError("Download cancelled by user")
@@ -45,180 +55,500 @@ def _validate_output_path(output_path):
     return abs_path
 
 
+def _is_congestion(error):
+    """Return True for request errors that signal an overloaded link or server"""
+    if isinstance(error, requests.exceptions.Timeout):
+        return True
+    response = getattr(error, "response", None)
+    return response is not None and response.status_code in (403, 429, 503)
+
+
 class MGet:
     """Multi-threaded file downloader with single thread fallback option"""
 
-    def __init__(self, default_threads=8):
-        """Initialize MGet downloader with configurable thread count"""
+    def __init__(self, default_threads=8, session=None, auto_concurrency=False):
+        """Initialize MGet downloader with configurable thread count
+
+        Args:
+            default_threads: Thread count used when none is given per download
+            session: Shared keep-alive session (default: a new pooled session)
+            auto_concurrency: If True, multi-thread downloads split the file into
+                AUTO_DOWNLOAD_RANGE_SIZE ranges and adapt the number of parallel
+                ranges to the network, starting from the thread count
+        """
         self.default_threads = default_threads
+        self.auto_concurrency = auto_concurrency
+        self.session = session if session is not None else create_session(default_threads)
 
     def get_file_size(self, url):
         """Get file size using HEAD request"""
         try:
-            response = requests.head(url, timeout=config.TIMEOUT_SHORT)
+            response = self.session.head(url, timeout=config.TIMEOUT_SHORT)
             file_size = int(response.headers.get("content-length", 0))
             return file_size
         except requests.exceptions.RequestException as e:
             raise ConnectionError(f"Failed to get file size: {e}")
 
-    def download_single_thread(self, url, output_path):
-        """Download file using single thread approach"""
+    def probe(self, url):
+        """Get the identity (size, ETag, Last-Modified) of a file with a HEAD request
+
+        Returns:
+            dict: Identity as built by DownloadState.identity_of()
+        """
+        try:
+            response = self.session.head(url, timeout=config.TIMEOUT_SHORT)
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            raise ConnectionError(f"Failed to get file size: {e}")
+        return DownloadState.identity_of(response.headers)
+
+    def download_single_thread(self, url, output_path, expected_md5=None):
+        """Download file using single thread approach
+
+        Progress is kept in a .mget-state sidecar, so an interrupted download
+        (single- or multi-thread) continues from where it stopped.
+
+        Args:
+            url: Download URL
+            output_path: Path to the output file
+            expected_md5: If given, the MD5 is computed while the file is
+                written and a mismatching download is removed and retried
+        """
+        return self._verified(self._single_thread_once, url, output_path, expected_md5)
+
+    def _verified(self, download, url, output_path, expected_md5, *args):
+        """Run a download and check its MD5, starting over on a mismatch
+
+        Args:
+            download: _single_thread_once or _multi_thread_once
+            url: Download URL
+            output_path: Path to the output file
+            expected_md5: Expected MD5 (hex or ETag form), or None to skip the check
+            *args: Extra arguments for download
+
+        Returns:
+            float: Elapsed seconds, or None on failure
+        """
+        expected = normalize_md5(expected_md5)
+        if expected_md5 and expected is None:
+            print(f"Ignoring invalid MD5 '{expected_md5}', the download will not be verified")
+
+        for attempt in range(config.DOWNLOAD_VERIFY_RETRIES + 1):
+            elapsed, md5 = download(url, output_path, *args, verify=expected is not None)
+            if elapsed is None or expected is None:
+                return elapsed
+            if md5 == expected:
+                print(f"MD5 verified: {md5}")
+                return elapsed
+
+            print(f"MD5 mismatch: expected {expected}, got {md5 or 'incomplete data'}")
+            try:
+                os.remove(output_path)
+            except OSError:
+                pass
+            if attempt < config.DOWNLOAD_VERIFY_RETRIES:
+                print("Corrupt download removed, downloading again")
+        print("Corrupt download removed")
+        return None
+
+    def _single_thread_once(self, url, output_path, verify=False):
+        """One single-thread download attempt (see download_single_thread)
+
+        Returns:
+            tuple: (elapsed seconds or None on failure, MD5 hex or None if not verified)
+        """
         start_time = time.time()
 
+        if DownloadState.pending(output_path):
+            try:
+                state = DownloadState.resume(output_path, self.probe(url))
+            except ConnectionError:
+                state = None
+            if state is not None:
+                return self._resume_single_thread(url, output_path, state, start_time, verify)
+
         try:
-            response = requests.get(url, stream=True, timeout=config.TIMEOUT_LONG)
+            response = self.session.get(url, stream=True, timeout=config.TIMEOUT_LONG)
             response.raise_for_status()
         except requests.exceptions.RequestException as e:
             print(f"Single-thread download failed: {e}")
-            return None
+            return None, None
 
-        file_size = int(response.headers.get("content-length", 0))
+        identity = DownloadState.identity_of(response.headers)
+        file_size = identity["size"]
         print(f"Single thread download - File size: {file_size/1024/1024:.2f} MB")
 
+        state = DownloadState(output_path, identity, [[0, file_size - 1, 0]])
+        state.flush()
+        # Bytes arrive in order, so the hash never needs to read the file back
+        verifier = StreamingMD5(file_size) if verify else None
+
         progress_bar = tqdm(
             total=file_size, unit="B", unit_scale=True, desc="Single thread"
         )
 
-        downloaded_size = 0
+        offset = 0
         try:
             with open(output_path, "wb") as f:
-                for chunk in response.iter_content(chunk_size=8192):
+                for chunk in response.iter_content(chunk_size=config.DOWNLOAD_CHUNK_SIZE):
                     if chunk:
+                        limiter.throttle(DOWNLOAD, len(chunk))
                         f.write(chunk)
                         progress_bar.update(len(chunk))
-                        downloaded_size += len(chunk)
+                        state.advance(0, len(chunk))
+                        if verifier is not None:
+                            verifier.update(offset, chunk)
+                        offset += len(chunk)
+        except requests.exceptions.RequestException as e:
+            progress_bar.close()
+            print(f"Single-thread download failed: {e}")
+            self._keep_partial(output_path, state)
+            return None, None
         except IOError as e:
             progress_bar.close()
             print(f"Write error: {e}")
-            if os.path.exists(output_path):
-                try:
-                    os.remove(output_path)
-                except OSError:
-                    pass
-            return None
+            self._keep_partial(output_path, state)
+            return None, None
+        except KeyboardInterrupt:
+            state.flush()
+            raise
 
         progress_bar.close()
+        state.remove()
         elapsed_time = time.time() - start_time
         print(f"Single thread download completed in {elapsed_time:.2f} seconds")
-        return elapsed_time
+        return elapsed_time, verifier.hexdigest() if verifier is not None else None
+
+    def _resume_single_thread(self, url, output_path, state, start_time, verify=False):
+        """Fetch the missing ranges of a partial download one after another"""
+        file_size = state.identity["size"]
+        print(
+            f"Single thread download - File size: {file_size/1024/1024:.2f} MB, "
+            f"resuming with {state.done_bytes/1024/1024:.2f} MB already downloaded"
+        )
+        try:
+            output = PreallocatedFile(output_path, file_size)
+        except OSError as e:
+            print(f"Failed to open {output_path}: {e}")
+            return None, None
+        verifier = self._resumed_verifier(state, output) if verify else None
+        progress_bar = tqdm(
+            total=file_size, initial=state.done_bytes, unit="B", unit_scale=True, desc="Single thread"
+        )
+        try:
+            # The hash may read bytes back, so the file stays open until it is done
+            with output:
+                self._run_workers(url, output, RangeScheduler(state), 1, progress_bar, verifier=verifier)
+                md5 = verifier.hexdigest() if verifier is not None else None
+        except (ConnectionError, IOError) as e:
+            progress_bar.close()
+            print(f"Single-thread download failed: {e}")
+            self._keep_partial(output_path, state)
+            return None, None
+        except KeyboardInterrupt:
+            state.flush()
+            raise
 
-    def download_chunk(self, args):
-        """Download specific byte range of a file"""
-        url, start, end, output_path, chunk_id = args
+        progress_bar.close()
+        state.remove()
+        elapsed_time = time.time() - start_time
+        print(f"Single thread download completed in {elapsed_time:.2f} seconds")
+        return elapsed_time, md5
+
+    @staticmethod
+    def _resumed_verifier(state, output):
+        """StreamingMD5 for a download that may already have bytes on disk
+
+        Bytes written by an earlier attempt are read back when the hash
+        cursor reaches them; new bytes are hashed as they arrive.
+        """
+        return StreamingMD5(
+            output.size,
+            read_at=output.read_at,
+            written=[(start, done) for start, _, done in state.ranges],
+        )
+
+    @staticmethod
+    def _keep_partial(output_path, state):
+        """After a failed download, save its progress or delete the partial file
+
+        Args:
+            output_path: Path to the output file
+            state: DownloadState of the download
+        """
+        if state.persist:
+            state.flush()
+            print("Partial download kept; run the same download again to resume")
+            return
+        try:
+            os.remove(output_path)
+        except OSError:
+            pass
+
+    def _run_workers(self, url, output, scheduler, num_workers, progress_bar, concurrency=None, verifier=None):
+        """Run range workers until the scheduler runs out of segments
+
+        Progress is read from the scheduler twice a second, so the bar costs
+        nothing per chunk.
+
+        Raises:
+            ConnectionError, IOError: The first error of a failed segment,
+                after the other workers have finished theirs
+        """
+        reported = 0
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            workers = [
+                executor.submit(self._range_worker, url, output, scheduler, concurrency, verifier)
+                for _ in range(num_workers)
+            ]
+            try:
+                running = set(workers)
+                while running:
+                    done, running = wait(running, timeout=0.5)
+                    if verifier is not None and any(worker.exception() for worker in done):
+                        # The failed segment will never reach the hash, so
+                        # don't hold the other workers back waiting for it
+                        verifier.release()
+                    written = scheduler.written_bytes
+                    progress_bar.update(written - reported)
+                    reported = written
+            except BaseException:
+                scheduler.cancel()
+                raise
+        for worker in workers:
+            worker.result()
+
+    def _range_worker(self, url, output, scheduler, concurrency=None, verifier=None):
+        """Download segments from the scheduler until none are left
+
+        A segment that fails on congestion (timeout, 429, 503 or 403) is
+        queued again behind a backoff, for any worker to take, up to
+        DOWNLOAD_RANGE_RETRIES times.
+
+        Args:
+            url: Download URL
+            output: PreallocatedFile the segments are written into
+            scheduler: RangeScheduler handing out segments
+            concurrency: Optional AdaptiveConcurrency; a slot is held for
+                each segment and its throughput reported to the controller
+            verifier: Optional StreamingMD5 told about every write
+        """
+        while True:
+            slot = concurrency.acquire() if concurrency is not None else None
+            segment = scheduler.next()
+            if segment is None:
+                if concurrency is not None:
+                    concurrency.release(slot)
+                return
+            progress = [0]
+            congested = False
+            try:
+                self._download_segment(url, segment, output, scheduler, concurrency, progress, verifier)
+            except ConnectionError as e:
+                congested = _is_congestion(e.__cause__)
+                # Queue the rest of the segment again behind a backoff instead
+                # of failing the whole download on one throttled request
+                if not congested or segment.retries >= config.DOWNLOAD_RANGE_RETRIES:
+                    raise
+                tqdm.write(f"{e}; retrying the rest of the range")
+                scheduler.retry(segment, backoff_delay(
+                    segment.retries + 1, config.UPLOAD_RETRY_BACKOFF, config.UPLOAD_RETRY_BACKOFF_MAX
+                ))
+            finally:
+                scheduler.finish(segment)
+                if concurrency is not None:
+                    concurrency.release(slot, progress[0], congested)
+
+    def _download_segment(self, url, segment, output, scheduler, concurrency=None, progress=None, verifier=None):
+        """Download one segment into its place in the output file
+
+        The request asks for the segment as handed out; if the scheduler
+        splits it meanwhile, the download stops at the new end.
+        """
+        chunk_id = segment.index
+        start, end = segment.position, segment.end
         headers = {"Range": f"bytes={start}-{end}"}
         try:
-            response = requests.get(url, headers=headers, stream=True, timeout=config.TIMEOUT_LONG)
+            response = self.session.get(url, headers=headers, stream=True, timeout=config.TIMEOUT_LONG)
             response.raise_for_status()
         except requests.exceptions.RequestException as e:
-            raise ConnectionError(f"Chunk {chunk_id} download failed: {e}")
+            raise ConnectionError(f"Chunk {chunk_id} download failed: {e}") from e
+        if response.status_code != 206 and (start, end) != (0, output.size - 1):
+            response.close()
+            raise ConnectionError(f"Chunk {chunk_id} download failed: server ignored the Range header")
 
-        chunk_path = f"{output_path}.part{chunk_id}"
+        offset = start
         try:
-            with open(chunk_path, "wb") as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    if chunk:
-                        f.write(chunk)
+            with response:
+                for chunk in response.iter_content(chunk_size=config.DOWNLOAD_CHUNK_SIZE):
+                    if not chunk:
+                        continue
+                    num_bytes = scheduler.claim(segment, len(chunk))
+                    if num_bytes:
+                        limiter.throttle(DOWNLOAD, num_bytes)
+                        data = chunk[:num_bytes] if num_bytes < len(chunk) else chunk
+                        output.write_at(offset, data)
+                        if verifier is not None:
+                            verifier.update(offset, data)
+                        offset += num_bytes
+                        scheduler.written(segment, num_bytes)
+                        if concurrency is not None:
+                            # Report long segments as they stream so the
+                            # controller's windows see steady throughput
+                            progress[0] += num_bytes
+                            if progress[0] >= 1024 * 1024:
+                                concurrency.add_bytes(progress[0])
+                                progress[0] = 0
+                    if num_bytes < len(chunk) or segment.remaining <= 0:
+                        break
+        except requests.exceptions.RequestException as e:
+            raise ConnectionError(f"Chunk {chunk_id} download failed: {e}") from e
         except IOError as e:
-            if os.path.exists(chunk_path):
-                try:
-                    os.remove(chunk_path)
-                except OSError:
-                    pass
             raise IOError(f"Failed to write chunk {chunk_id}: {e}")
 
-        return chunk_path, chunk_id, end - start + 1
+        if segment.remaining > 0:
+            raise ConnectionError(
+                f"Chunk {chunk_id} download failed: stopped at byte {offset} of {start}-{segment.end}"
+            )
 
-    def download_multi_thread(self, url, output_path, num_threads=None):
-        """Download file using multiple parallel threads"""
+    def download_multi_thread(self, url, output_path, num_threads=None, expected_md5=None):
+        """Download file using multiple parallel threads
+
+        The output file is preallocated to the full size and every range is
+        written straight to its offset, so there is no merge step. The file
+        starts out as num_threads ranges; a thread that runs out of work
+        splits the largest range still downloading (see RangeScheduler), so
+        no single slow connection is left holding a large tail.
+        Progress is kept in a .mget-state sidecar: if a range fails, the
+        other ranges still finish and running the same download again (with
+        the same or a freshly resolved URL) fetches only the missing bytes.
+        With auto_concurrency the file is split into more, smaller ranges and
+        an AdaptiveConcurrency controller decides how many run at once,
+        starting from num_threads.
+
+        With expected_md5 the MD5 is computed in file order while ranges
+        land (see StreamingMD5), and a mismatching download is removed and
+        retried up to DOWNLOAD_VERIFY_RETRIES times. The file is then handed
+        out in small segments in file order and workers wait for the hash
+        to catch up, so the bytes ahead of it fit in DOWNLOAD_VERIFY_BUFFER
+        and are not read back from disk unless a range stalls.
+
+        Returns:
+            float: Elapsed seconds, or None on failure
+        """
+        return self._verified(self._multi_thread_once, url, output_path, expected_md5, num_threads)
+
+    def _multi_thread_once(self, url, output_path, num_threads=None, verify=False):
+        """One multi-thread download attempt (see download_multi_thread)
+
+        Returns:
+            tuple: (elapsed seconds or None on failure, MD5 hex or None if not verified)
+        """
         if num_threads is None:
             num_threads = self.default_threads
+        concurrency = None
+        if self.auto_concurrency:
+            concurrency = AdaptiveConcurrency(
+                initial=num_threads,
+                maximum=max(num_threads, config.AUTO_CONCURRENCY_MAX_DOWNLOAD)
+            )
+        max_threads = concurrency.maximum if concurrency else num_threads
+        ensure_pool_size(self.session, max_threads)
 
         start_time = time.time()
-        chunk_files = []
 
         try:
-            file_size = self.get_file_size(url)
+            identity = self.probe(url)
         except ConnectionError as e:
             print(f"Multi-thread download failed: {e}")
-            return None
+            return None, None
+        file_size = identity["size"]
 
         print(
             f"Multi-thread download - File size: {file_size/1024/1024:.2f} MB, Threads: {num_threads}"
         )
 
-        chunk_size = file_size // num_threads
-        chunks = []
-        for i in range(num_threads):
-            start_byte = i * chunk_size
-            end_byte = (
-                start_byte + chunk_size - 1 if i < num_threads - 1 else file_size - 1
-            )
-            chunks.append((url, start_byte, end_byte, output_path, i))
+        state = DownloadState.resume(output_path, identity)
+        if state is not None:
+            print(f"Resuming download: {state.done_bytes/1024/1024:.2f} MB already downloaded")
+        else:
+            num_chunks = num_threads
+            if concurrency is not None:
+                num_chunks = max(num_threads, -(-file_size // config.AUTO_DOWNLOAD_RANGE_SIZE))
+            num_chunks = max(1, min(num_chunks, file_size))
+
+            chunk_size = file_size // num_chunks
+            ranges = []
+            for i in range(num_chunks):
+                start_byte = i * chunk_size
+                end_byte = (
+                    start_byte + chunk_size - 1 if i < num_chunks - 1 else file_size - 1
+                )
+                ranges.append([start_byte, end_byte, 0])
+            state = DownloadState(output_path, identity, ranges)
 
+        try:
+            output = PreallocatedFile(output_path, file_size)
+        except OSError as e:
+            print(f"Failed to create {output_path}: {e}")
+            return None, None
+        state.flush()
+        verifier = self._resumed_verifier(state, output) if verify else None
+
+        # Verification hashes in file order, so keep the ranges being written
+        # within reach of the in-memory buffer instead of far apart
+        segment_size = None
+        if verify:
+            segment_size = max(
+                config.DOWNLOAD_CHUNK_SIZE,
+                min(config.AUTO_DOWNLOAD_RANGE_SIZE, config.DOWNLOAD_VERIFY_BUFFER // (2 * max_threads))
+            )
+        scheduler = RangeScheduler(state, segment_size=segment_size)
         progress_bar = tqdm(
-            total=file_size, unit="B", unit_scale=True, desc="Multi-thread"
+            total=file_size, initial=state.done_bytes, unit="B", unit_scale=True, desc="Multi-thread"
         )
-        downloaded = 0
         failed = False
 
         try:
-            with ThreadPoolExecutor(max_workers=num_threads) as executor:
-                for chunk_path, _, size in executor.map(self.download_chunk, chunks):
-                    chunk_files.append(chunk_path)
-                    downloaded += size
-                    progress_bar.update(size)
+            # The hash may read bytes back, so the file stays open until it is done
+            with output:
+                self._run_workers(url, output, scheduler, max_threads, progress_bar, concurrency, verifier)
+                md5 = verifier.hexdigest() if verifier is not None else None
         except (ConnectionError, IOError) as e:
             print(f"\nMulti-thread download failed: {e}")
             failed = True
+        except KeyboardInterrupt:
+            state.flush()
+            raise
 
         progress_bar.close()
 
         if failed:
-            for cf in chunk_files:
-                try:
-                    os.remove(cf)
-                except OSError:
-                    pass
-            return None
-
-        try:
-            with open(output_path, "wb") as output_file:
-                for i in range(num_threads):
-                    chunk_path = f"{output_path}.part{i}"
-                    try:
-                        with open(chunk_path, "rb") as chunk_file:
-                            output_file.write(chunk_file.read())
-                    finally:
-                        try:
-                            os.remove(chunk_path)
-                        except OSError:
-                            pass
-        except IOError as e:
-            print(f"Failed to combine chunks: {e}")
-            for cf in chunk_files:
-                try:
-                    os.remove(cf)
-                except OSError:
-                    pass
-            return None
+            self._keep_partial(output_path, state)
+            return None, None
+        state.remove()
 
         elapsed_time = time.time() - start_time
         print(f"Multi-thread download completed in {elapsed_time:.2f} seconds")
-        return elapsed_time
+        if scheduler.splits:
+            print(f"Ranges split for idle threads: {scheduler.splits}")
+        if concurrency is not None:
+            print(f"Adaptive thread count settled at {concurrency.limit}")
+        return elapsed_time, md5
 
-    def download(self, url, output_path, num_threads=None, force_single=False):
+    def download(self, url, output_path, num_threads=None, force_single=False, expected_md5=None):
         """Intelligently select download mode based on parameters (with path validation)"""
         validated_path = _validate_output_path(output_path)
-        return self._download_raw(url, validated_path, num_threads, force_single)
+        return self._download_raw(url, validated_path, num_threads, force_single, expected_md5)
 
-    def _download_raw(self, url, output_path, num_threads=None, force_single=False):
+    def _download_raw(self, url, output_path, num_threads=None, force_single=False, expected_md5=None):
         """Internal download logic without path validation (for use when path already validated)"""
         if force_single:
-            return self.download_single_thread(url, output_path)
+            return self.download_single_thread(url, output_path, expected_md5)
         else:
             if num_threads is None:
                 num_threads = self.default_threads
-            return self.download_multi_thread(url, output_path, num_threads)
+            return self.download_multi_thread(url, output_path, num_threads, expected_md5)
 
 
 def download_single_thread(url, output_path):
@@ -248,20 +578,27 @@ def main():
     parser.add_argument(
         "-s", "--single", action="store_true", help="Use single-threaded download"
     )
+    parser.add_argument(
+        "-a", "--auto-concurrency", action="store_true",
+        help="Adapt the number of parallel ranges to the network (-t is the starting point)"
+    )
+    parser.add_argument(
+        "--md5", help="Expected MD5; verify the download while it is written and retry on mismatch"
+    )
     args = parser.parse_args()
 
-    downloader = MGet(default_threads=args.threads)
+    downloader = MGet(default_threads=args.threads, auto_concurrency=args.auto_concurrency)
 
     print(f"Starting download: {args.url}")
 
     if args.single:
         print("Using single-threaded mode")
-        single_time = downloader.download_single_thread(args.url, args.output)
+        single_time = downloader.download_single_thread(args.url, args.output, args.md5)
         if single_time is not None:
             print(f"Download complete, elapsed time: {single_time:.2f} seconds")
     else:
         print(f"Using multi-threaded mode (threads: {args.threads})")
-        multi_time = downloader.download_multi_thread(args.url, args.output, args.threads)
+        multi_time = downloader.download_multi_thread(args.url, args.output, args.threads, args.md5)
 
         if multi_time is not None and args.output.endswith("_multi"):
             single_output = f"{args.output[:-6]}_single"
@@ -7,8 +7,27 @@ import time
 import hashlib
 import requests
 from tqdm import tqdm
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import queue
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 from tosasitill_123pan import config
+from utils.presign import PresignedUrlPool
+from utils.hash_cache import HashCache
+from utils.upload_journal import UploadJournal
+from utils.remote_index import RemoteFolderIndex
+from utils.ratelimit import TokenBucket
+from utils.retry import RetryBudget, backoff_delay
+from utils.fileio import BufferPool, MappedFile, read_exactly
+from utils.bandwidth import limiter
+from utils.concurrency import AdaptiveConcurrency
+
+# Marks a file whose MD5 the upload worker computes while reading it for upload
+HASH_ON_UPLOAD = object()
+
+# HTTP statuses below 500 that are worth retrying a part PUT for
+# (400 covers S3's RequestTimeout; 403 an expired presigned URL)
+RETRY_STATUS = {400, 403, 408, 429}
 
 
 def format_size(size_bytes):
@@ -30,6 +49,81 @@ def format_size(size_bytes):
         return f"{size_bytes/(1024*1024*1024):.2f} GB"
 
 
+class ThroughputMeter:
+    """Thread-safe moving average of per-connection upload speed
+
+    Each completed part PUT contributes one sample; the estimate is an
+    exponentially weighted moving average so it follows changing links.
+    """
+
+    def __init__(self, weight=0.3):
+        self.weight = weight
+        self.bytes_per_sec = None
+        self._lock = threading.Lock()
+
+    def record(self, num_bytes, seconds):
+        """Add one transfer sample"""
+        if seconds <= 0 or num_bytes <= 0:
+            return
+        rate = num_bytes / seconds
+        with self._lock:
+            if self.bytes_per_sec is None:
+                self.bytes_per_sec = rate
+            else:
+                self.bytes_per_sec += self.weight * (rate - self.bytes_per_sec)
+
+
+class DurationStats:
+    """Thread-safe count, mean and maximum of recorded durations"""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self.count += 1
+            self.total += seconds
+            self.max = max(self.max, seconds)
+
+    def summary(self):
+        """Return 'avg X.XXs, max Y.YYs', or None if nothing was recorded"""
+        with self._lock:
+            if not self.count:
+                return None
+            return f"avg {self.total / self.count:.2f}s, max {self.max:.2f}s"
+
+
+class RecentKeys:
+    """Thread-safe set that forgets its least recently added keys past a limit
+
+    Groups identical files in directory uploads with bounded memory: a
+    forgotten key only means a later copy is hashed or uploaded on its own,
+    and the server still recognises its MD5.
+    """
+
+    def __init__(self, limit=None):
+        self.limit = limit or config.DEDUP_INDEX_SIZE
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, key):
+        """Add a key (or refresh it), returning True if it was already present"""
+        with self._lock:
+            present = key in self._keys
+            self._keys[key] = None
+            self._keys.move_to_end(key)
+            if len(self._keys) > self.limit:
+                self._keys.popitem(last=False)
+            return present
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._keys
+
+
 class MPush:
     """Upload handler for 123Pan Cloud Storage
 
@@ -41,33 +135,143 @@ class MPush:
     - Resumable chunk uploads for large files
     """
 
-    def __init__(self, pan):
+    def __init__(self, pan, part_workers=None, hash_cache=None):
         """Initialize MPush with an authenticated Pan123 instance
 
         Args:
             pan: Authenticated Pan123 instance for API calls
+            part_workers: Concurrent part uploads within a single file
+                (default: config.DEFAULT_PART_WORKERS)
+            hash_cache: HashCache used to avoid re-hashing unchanged files
+                (default: a HashCache at config.HASH_CACHE_FILE)
         """
         self.pan = pan
+        self.part_workers = part_workers or config.DEFAULT_PART_WORKERS
+        self.hash_cache = hash_cache if hash_cache is not None else HashCache()
+        self.rehash = False  # If True, ignore cached MD5s (fresh hashes are still cached)
+        self.use_mmap = False  # If True, hash and upload through a memory map of each file
+        self.journal = UploadJournal()
+        self.throughput = ThroughputMeter()
+        self.finalize_times = DurationStats()  # s3_complete through upload_complete
+        self.remote_index = RemoteFolderIndex(pan)
+        self.mkdir_limiter = TokenBucket(config.MKDIR_RATE, config.MKDIR_BURST)
+        # Part retries allowed per upload command; reset by reset_retry_budget()
+        self.retry_budget = RetryBudget(config.UPLOAD_RETRY_BUDGET_JOB)
+        self.buffer_pool = BufferPool()  # Shared by all files, so part memory stays bounded
+        self.concurrency = None  # AdaptiveConcurrency gating part PUTs when auto-concurrency is on
+
+    def set_auto_concurrency(self, enabled):
+        """Turn adaptive (AIMD) control of concurrent part uploads on or off
+
+        When on, part_workers and the directory max_workers only serve as
+        defaults; the number of concurrent part PUTs across all files follows
+        measured throughput and congestion (see AdaptiveConcurrency).
+
+        Args:
+            enabled: True to start a fresh controller, False to remove it
+        """
+        self.concurrency = AdaptiveConcurrency(initial=self.part_workers) if enabled else None
+
+    def reset_retry_budget(self):
+        """Start a new job-wide part retry budget (call once per upload command)"""
+        self.retry_budget.reset()
+
+    def choose_block_size(self, file_size):
+        """Pick the part size for a new upload from file size and measured speed
+
+        Parts grow so that large files need about TARGET_PART_COUNT parts and,
+        once the link speed is known, so that one part takes about
+        TARGET_PART_SECONDS on one connection. Parts never shrink below
+        DEFAULT_BLOCK_SIZE, never exceed MAX_BLOCK_SIZE (unless needed to stay
+        within MAX_PART_COUNT), and stay small enough to keep every part
+        worker busy.
+
+        Args:
+            file_size: Size of the file in bytes
+
+        Returns:
+            int: Part size in bytes (a multiple of 1 MB)
+        """
+        mb = 1024 * 1024
+        block_size = -(-file_size // config.TARGET_PART_COUNT)
+
+        rate = self.throughput.bytes_per_sec
+        if rate:
+            by_speed = int(rate * config.TARGET_PART_SECONDS)
+            # Don't let a fast link collapse a file into fewer parts than workers
+            block_size = max(block_size, min(by_speed, file_size // self.part_workers))
+
+        block_size = min(max(block_size, config.DEFAULT_BLOCK_SIZE), config.MAX_BLOCK_SIZE)
+        block_size = max(block_size, -(-file_size // config.MAX_PART_COUNT))
+        return -(-block_size // mb) * mb
+
+    def part_timeout(self, length):
+        """Timeout for PUTting one part, derived from its size and measured speed
+
+        Args:
+            length: Part size in bytes
+
+        Returns:
+            tuple: (connect timeout, send/read timeout) in seconds for requests
+        """
+        rate = self.throughput.bytes_per_sec or config.UPLOAD_TIMEOUT_MIN_RATE
+        rate = max(rate, config.UPLOAD_TIMEOUT_MIN_RATE)
+        expected = length / rate
+        return (config.TIMEOUT_SHORT, max(config.TIMEOUT_UPLOAD_PART, expected * config.UPLOAD_TIMEOUT_SLOWDOWN))
 
     @staticmethod
-    def compute_file_md5(file_path):
+    def compute_file_md5(file_path, use_mmap=False):
         """Calculate MD5 hash of a file using chunked reading
 
+        Args:
+            file_path: Path to the file to hash
+            use_mmap: If True, hash over a memory map instead of reading
+
+        Returns:
+            str: Hexadecimal MD5 hash string
+        """
+        if use_mmap:
+            with MappedFile(file_path) as mapped:
+                return mapped.md5()
+
+        md5 = hashlib.md5()
+        buffer = bytearray(config.HASH_READ_SIZE)
+        view = memoryview(buffer)
+        with open(file_path, "rb", buffering=0) as f:
+            # hashlib releases the GIL for large updates, so hashing threads
+            # run in parallel with each other and with the upload workers
+            for n in iter(lambda: f.readinto(buffer), 0):
+                md5.update(view[:n])
+        return md5.hexdigest()
+
+    def get_file_md5(self, file_path):
+        """Return the MD5 of a file, using the persistent cache when possible
+
+        The file is only read if it is not cached, its size or mtime changed
+        since it was hashed, or self.rehash is set.
+
         Args:
             file_path: Path to the file to hash
 
         Returns:
             str: Hexadecimal MD5 hash string
         """
-        with open(file_path, "rb") as f:
-            md5 = hashlib.md5()
-            for chunk in iter(lambda: f.read(64 * 1024), b""):
-                md5.update(chunk)
-            return md5.hexdigest()
+        file_stat = os.stat(file_path)
+        if not self.rehash:
+            md5 = self.hash_cache.get(file_stat)
+            if md5:
+                return md5
+
+        md5 = self.compute_file_md5(file_path, self.use_mmap)
+        self.hash_cache.put(file_path, file_stat, md5)
+        return md5
 
     def check_file_exists_with_md5(self, file_name, local_md5, parent_id=None):
         """Check if a file with same name and MD5 already exists in the target directory
 
+        Uses the shared remote folder index, so concurrent workers neither
+        relist the folder nor change the current directory.
+
         Args:
             file_name: Name of the file to check
             local_md5: MD5 hash of the local file
@@ -76,70 +280,241 @@ class MPush:
         Returns:
             bool: True if file exists with same MD5, False otherwise
         """
+        if parent_id is None:
+            parent_id = self.pan.parentFileId
         try:
-            if parent_id is not None and self.pan.parentFileId != parent_id:
-                self.pan.cdById(parent_id)
-
-            if self.pan.list is None:
+            file_info = self.remote_index.find_file(parent_id, file_name)
+            if file_info is None:
                 return False
-
-            for file_info in self.pan.list:
-                if file_info["FileName"] == file_name and file_info["Type"] == 0:
-                    remote_md5 = file_info.get("Etag", "").lower()
-                    if remote_md5 and remote_md5 == local_md5.lower():
-                        return True
-            return False
+            remote_md5 = file_info.get("Etag", "").lower()
+            return bool(remote_md5) and remote_md5 == local_md5.lower()
         except Exception as e:
             tqdm.write(f"Warning: Could not check for existing file: {e}")
             return False
 
-    def upload_file(self, file_path, parent_id=None, sure=None, skip_existing=True):
-        """Upload a single file to 123Pan Cloud
+    def _delete_existing(self, file_name, parent_id):
+        """Move an existing remote file with the same name to the recycle bin
 
         Args:
-            file_path: Path to the file to upload
-            parent_id: Parent folder ID (None for current directory)
-            sure: Duplicate handling strategy - "1":keep both, "2":overwrite
-            skip_existing: If True, skip files that already exist with same MD5 (default: True)
-
-        Returns:
-            dict: Upload result with 'success', 'skipped', 'file_name' keys
+            file_name: Name of the file
+            parent_id: Remote parent folder ID
         """
-        result = {'success': False, 'skipped': False, 'file_name': ''}
+        file_info = self.remote_index.find_file(parent_id, file_name)
+        if file_info is None:
+            return
+        tqdm.write(f"Deleting existing file: {file_name}")
+        if self.pan.trash(file_info, operation=True) is not None:
+            self.remote_index.remove(parent_id, file_name)
+
+    def _upload_part(self, file_path, part_number, offset, length, presign, abort, budget,
+                     mapped=None):
+        """Read one part of a file into a pooled buffer and upload it
+
+        The part is read with readinto() into a buffer borrowed from
+        buffer_pool, so waiting for a free buffer also holds the worker back
+        until earlier parts have been sent. With a memory map the part body
+        is a slice of the mapping instead and no buffer is used.
 
-        if not os.path.exists(file_path) or not os.path.isfile(file_path):
-            tqdm.write(f"Error: {file_path} is not a valid file")
-            return result
+        Args:
+            file_path: Path to the local file
+            part_number: 1-based part number
+            offset: Byte offset of the part in the file
+            length: Number of bytes in the part
+            presign: PresignedUrlPool for this upload
+            abort: threading.Event set when another part of the file failed
+            budget: RetryBudget shared by the parts of this file
+            mapped: Optional MappedFile of the file
 
-        file_path = file_path.replace('"', "").replace("\\", "/")
-        file_name = os.path.basename(file_path)
-        file_size = os.path.getsize(file_path)
-        result['file_name'] = file_name
+        Returns:
+            int: Number of bytes uploaded, or None on failure
+        """
+        if abort.is_set():
+            return None
+
+        if mapped is not None:
+            with mapped.slice(offset, length) as data:
+                if len(data) != length:
+                    tqdm.write(f"Chunk {part_number} read failed: file changed during upload")
+                    return None
+                return self._put_part(data, part_number, presign, abort, budget)
+
+        with self.buffer_pool.borrow(length) as data:
+            if abort.is_set():
+                return None
+            with open(file_path, "rb", buffering=0) as f:
+                f.seek(offset)
+                if read_exactly(f, data) != length:
+                    tqdm.write(f"Chunk {part_number} read failed: file changed during upload")
+                    return None
+            return self._put_part(data, part_number, presign, abort, budget)
+
+    def _put_part(self, data, part_number, presign, abort, budget):
+        """PUT one part to its presigned URL, retrying transient failures
+
+        Failed PUTs (connection errors, timeouts, 5xx, throttling) are retried
+        with jittered exponential backoff, up to UPLOAD_PART_RETRIES times and
+        as long as the retry budget allows. A 403 means the presigned URL was
+        rejected (usually expired), so the part is presigned again first.
+        With auto-concurrency each attempt holds a controller slot, and
+        timeouts and 429/503 responses are reported as congestion.
 
-        tqdm.write(f"Preparing to upload: {file_name} ({format_size(file_size)})")
+        Args:
+            data: Part body (bytes-like)
+            part_number: 1-based part number
+            presign: PresignedUrlPool for this upload
+            abort: threading.Event set when another part of the file failed
+            budget: RetryBudget shared by the parts of this file
 
-        tqdm.write("Calculating file MD5...")
-        md5 = self.compute_file_md5(file_path)
+        Returns:
+            int: Number of bytes uploaded, or None on failure
+        """
+        length = len(data)
+        attempt = 0
+        while True:
+            upload_url = presign.get(part_number)
+            if upload_url is None:
+                error = "could not get upload link"
+            else:
+                slot = self.concurrency.acquire() if self.concurrency else None
+                sent = 0
+                congested = False
+                started = time.monotonic()
+                try:
+                    put_res = self.pan.transfer_session.put(
+                        upload_url, data=limiter.upload_body(data), timeout=self.part_timeout(length)
+                    )
+                    put_res.raise_for_status()
+                    self.throughput.record(length, time.monotonic() - started)
+                    sent = length
+                    return length
+                except requests.exceptions.RequestException as e:
+                    error = e
+                    status = e.response.status_code if e.response is not None else None
+                    congested = status in (429, 503) or isinstance(e, requests.exceptions.Timeout)
+                    if status == 403:
+                        presign.invalidate(part_number, upload_url)
+                    elif status is not None and status < 500 and status not in RETRY_STATUS:
+                        tqdm.write(f"Chunk {part_number} upload failed: {e}")
+                        return None
+                finally:
+                    if slot is not None:
+                        self.concurrency.release(slot, sent, congested)
+
+            attempt += 1
+            if attempt > config.UPLOAD_PART_RETRIES or abort.is_set() or not budget.take():
+                tqdm.write(f"Chunk {part_number} upload failed: {error}")
+                return None
+            delay = backoff_delay(attempt, config.UPLOAD_RETRY_BACKOFF, config.UPLOAD_RETRY_BACKOFF_MAX)
+            tqdm.write(f"Chunk {part_number} upload failed ({error}), retry {attempt} in {delay:.1f}s")
+            if abort.wait(delay):
+                return None
+
+    def _upload_parts(self, file_path, file_size, block_size, upload_session, pbar,
+                      done_parts=(), on_part_done=None, data=None):
+        """Upload all parts of a file, keeping up to part_workers parts in flight
+
+        Each worker reads its own part into a buffer from the shared
+        buffer_pool, so part memory is bounded by the pool, not the workers
+        (with use_mmap, parts are slices of one mapping of the file instead).
+        Presigned URLs are fetched in batches ahead of the workers. Parts
+        retry on their own (see _put_part); a part that still fails stops the
+        remaining ones.
 
-        if parent_id is None:
-            parent_id = self.pan.parentFileId
+        Args:
+            file_path: Path to the local file
+            file_size: Size of the file in bytes
+            block_size: Part size in bytes
+            upload_session: Dict with bucket, key, uploadId and StorageNode
+            pbar: tqdm progress bar updated as parts complete
+            done_parts: Part numbers already uploaded (skipped when resuming)
+            on_part_done: Optional callback(part_number) after each uploaded part
+            data: File contents already read into memory (single-part files
+                only); sent as is instead of reading the file again
 
-        if skip_existing:
-            if self.check_file_exists_with_md5(file_name, md5, parent_id):
-                tqdm.write(f"Skipped (same MD5 exists): {file_name}")
-                result['success'] = True
-                result['skipped'] = True
-                return result
+        Returns:
+            bool: True if every part was uploaded, False otherwise
+        """
+        all_parts = [
+            (offset // block_size + 1, offset, min(block_size, file_size - offset))
+            for offset in range(0, file_size, block_size)
+        ]
+        parts = [part for part in all_parts if part[0] not in done_parts]
+        pbar.update(sum(length for part_number, _, length in all_parts if part_number in done_parts))
+        if not parts:
+            return True
+
+        if len(all_parts) == 1:
+            # Send a lone part on the calling thread: no executor, no prefetcher
+            part_number, offset, length = parts[0]
+            budget = RetryBudget(config.UPLOAD_RETRY_BUDGET_FILE, parent=self.retry_budget)
+            with PresignedUrlPool(self.pan, upload_session, 1) as presign:
+                if data is not None:
+                    uploaded = self._put_part(data, part_number, presign, threading.Event(), budget)
+                else:
+                    uploaded = self._upload_part(
+                        file_path, part_number, offset, length, presign, threading.Event(), budget
+                    )
+            if uploaded is None:
+                return False
+            pbar.update(uploaded)
+            return True
+
+        workers = self.concurrency.maximum if self.concurrency else self.part_workers
+        self.pan.ensure_pool_size(2, workers)
+        abort = threading.Event()
+        budget = RetryBudget(config.UPLOAD_RETRY_BUDGET_FILE, parent=self.retry_budget)
+        mapped = MappedFile(file_path) if self.use_mmap else None
+        try:
+            with PresignedUrlPool(self.pan, upload_session, len(all_parts)) as presign, \
+                    ThreadPoolExecutor(max_workers=min(workers, len(parts))) as executor:
+                futures = {
+                    executor.submit(
+                        self._upload_part, file_path, part_number, offset, length,
+                        presign, abort, budget, mapped
+                    ): part_number
+                    for part_number, offset, length in parts
+                }
+                for future in as_completed(futures):
+                    try:
+                        uploaded = future.result()
+                    except Exception as e:
+                        tqdm.write(f"Chunk upload failed: {e}")
+                        uploaded = None
+                    if uploaded is None:
+                        abort.set()
+                        for pending in futures:
+                            pending.cancel()
+                        return False
+                    pbar.update(uploaded)
+                    if on_part_done is not None:
+                        on_part_done(futures[future])
+        finally:
+            if mapped is not None:
+                mapped.close()
+
+        return True
+
+    def _index_uploaded(self, parent_id, file_name, file_size, md5, upload_data):
+        """Add a freshly uploaded file to the remote folder index"""
+        info = dict(upload_data.get("Info") or {})
+        info.setdefault("FileId", upload_data.get("FileId"))
+        info.update({"FileName": file_name, "Type": 0, "Size": file_size, "Etag": md5})
+        self.remote_index.add(parent_id, info)
+
+    def _request_upload(self, file_name, md5, file_size, parent_id, sure):
+        """Open an upload session with upload_request, handling name conflicts
 
-        if sure == "2":
-            self.pan.get_dir()
-            for i, file_info in enumerate(self.pan.list):
-                if file_info["FileName"] == file_name and file_info["Type"] == 0:
-                    tqdm.write(f"Deleting existing file: {file_name}")
-                    self.pan.delete_file(i, by_num=True, operation=True)
-                    self.pan.get_dir()
-                    break
+        Args:
+            file_name: Remote file name
+            md5: MD5 of the file
+            file_size: Size of the file in bytes
+            parent_id: Remote parent folder ID
+            sure: Duplicate handling strategy - "1":keep both, "2":overwrite
 
+        Returns:
+            dict: 'data' of the upload_request response (Reuse set when the
+                server already has the content), or None on failure/cancel
+        """
         list_up_request = {
             "driveId": 0,
             "etag": md5,
@@ -151,7 +526,7 @@ class MPush:
         }
 
         try:
-            up_res = requests.post(
+            up_res = self.pan.session.post(
                 config.URL_UPLOAD_REQUEST,
                 headers=self.pan.headerLogined,
                 json=list_up_request,
@@ -160,10 +535,10 @@ class MPush:
             up_res_json = up_res.json()
         except requests.exceptions.RequestException as e:
             tqdm.write(f"Upload request failed: {e}")
-            return result
+            return None
         except ValueError as e:
             tqdm.write(f"Upload request parse failed: {e}")
-            return result
+            return None
 
         code = up_res_json.get("code")
 
@@ -177,20 +552,15 @@ class MPush:
             if sure == "1":
                 list_up_request["duplicate"] = 1
             elif sure == "2":
-                self.pan.get_dir()
-                for i, file_info in enumerate(self.pan.list):
-                    if file_info["FileName"] == file_name and file_info["Type"] == 0:
-                        tqdm.write(f"Deleting existing file: {file_name}")
-                        self.pan.delete_file(i, by_num=True, operation=True)
-                        self.pan.get_dir()
-                        break
+                self.remote_index.invalidate(parent_id)
+                self._delete_existing(file_name, parent_id)
                 list_up_request["duplicate"] = 2
             else:
                 tqdm.write("Upload cancelled")
-                return result
+                return None
 
             try:
-                up_res = requests.post(
+                up_res = self.pan.session.post(
                     config.URL_UPLOAD_REQUEST,
                     headers=self.pan.headerLogined,
                     json=list_up_request,
@@ -199,136 +569,264 @@ class MPush:
                 up_res_json = up_res.json()
             except requests.exceptions.RequestException as e:
                 tqdm.write(f"Upload request failed after duplicate handling: {e}")
-                return result
+                return None
             except ValueError as e:
                 tqdm.write(f"Upload request parse failed: {e}")
-                return result
+                return None
             code = up_res_json.get("code")
 
-        if code == 0:
-            reuse = up_res_json["data"].get("Reuse")
-            if reuse:
-                tqdm.write(f"Upload successful, file MD5 reused: {file_name}")
-                result['success'] = True
-                return result
-        else:
+        if code != 0:
             tqdm.write(f"Upload request failed: {up_res_json}")
-            return result
+            return None
+
+        return up_res_json["data"]
 
-        bucket = up_res_json["data"]["Bucket"]
-        storage_node = up_res_json["data"]["StorageNode"]
-        upload_key = up_res_json["data"]["Key"]
-        upload_id = up_res_json["data"]["UploadId"]
-        up_file_id = up_res_json["data"]["FileId"]
-
-        start_data = {
-            "bucket": bucket,
-            "key": upload_key,
-            "uploadId": upload_id,
-            "storageNode": storage_node,
+    def _list_uploaded_parts(self, upload_session):
+        """Ask the server which parts of a multipart upload it already holds
+
+        Args:
+            upload_session: Dict with bucket, key, uploadId and StorageNode
+
+        Returns:
+            dict: Part number -> size in bytes, or None on failure
+        """
+        list_parts_data = {
+            "bucket": upload_session["bucket"],
+            "key": upload_session["key"],
+            "uploadId": upload_session["uploadId"],
+            "storageNode": upload_session["StorageNode"],
         }
 
         try:
-            start_res = requests.post(
+            list_parts_res = self.pan.session.post(
                 config.URL_S3_LIST_PARTS,
                 headers=self.pan.headerLogined,
-                json=start_data,
+                json=list_parts_data,
                 timeout=config.TIMEOUT_MEDIUM
             )
-            start_res_json = start_res.json()
+            list_parts_json = list_parts_res.json()
         except requests.exceptions.RequestException as e:
-            tqdm.write(f"Failed to get transfer list: {e}")
-            return result
+            tqdm.write(f"Failed to list uploaded parts: {e}")
+            return None
         except ValueError as e:
-            tqdm.write(f"Failed to parse transfer list response: {e}")
-            return result
+            tqdm.write(f"Failed to parse parts list response: {e}")
+            return None
 
-        if start_res_json.get("code") != 0:
-            tqdm.write(f"Failed to get transfer list: {start_res_json}")
-            return result
+        if list_parts_json.get("code") != 0:
+            tqdm.write(f"s3_list_upload_parts failed: {list_parts_json}")
+            return None
 
-        block_size = config.DEFAULT_BLOCK_SIZE
-        part_number_start = 1
+        parts = (list_parts_json.get("data") or {}).get("Parts") or []
+        return {int(part["PartNumber"]): int(part.get("Size", 0)) for part in parts}
 
-        with open(file_path, "rb") as f, tqdm(
-            total=file_size, unit="B", unit_scale=True, desc=file_name, position=1, leave=False
-        ) as pbar:
-            while True:
-                data = f.read(block_size)
-                if not data:
-                    break
+    def _resume_upload(self, journal_key, file_size):
+        """Reconcile a journaled upload session with the server
 
-                get_link_data = {
-                    "bucket": bucket,
-                    "key": upload_key,
-                    "partNumberEnd": part_number_start + 1,
-                    "partNumberStart": part_number_start,
-                    "uploadId": upload_id,
-                    "StorageNode": storage_node,
-                }
+        Args:
+            journal_key: Key of the upload in self.journal
+            file_size: Current size of the local file
 
-                try:
-                    get_link_res = requests.post(
-                        config.URL_S3_PREPARE_PARTS,
-                        headers=self.pan.headerLogined,
-                        json=get_link_data,
-                        timeout=config.TIMEOUT_MEDIUM
-                    )
-                    get_link_res_json = get_link_res.json()
-                except requests.exceptions.RequestException as e:
-                    tqdm.write(f"Failed to get upload link: {e}")
-                    return result
-                except ValueError as e:
-                    tqdm.write(f"Failed to parse upload link response: {e}")
-                    return result
-
-                if get_link_res_json.get("code") != 0:
-                    tqdm.write(f"Failed to get upload link: {get_link_res_json}")
-                    return result
-
-                upload_url = get_link_res_json["data"]["presignedUrls"][
-                    str(part_number_start)
-                ]
-                try:
-                    put_res = requests.put(upload_url, data=data, timeout=config.TIMEOUT_UPLOAD_PART)
-                    put_res.raise_for_status()
-                except requests.exceptions.RequestException as e:
-                    tqdm.write(f"Chunk upload failed: {e}")
-                    return result
+        Returns:
+            tuple: (upload_data, block_size, done_parts) to continue the upload,
+                or None if there is nothing to resume
+        """
+        entry = self.journal.get(journal_key)
+        if entry is None:
+            return None
+        if entry["size"] != file_size:
+            self.journal.remove(journal_key)
+            return None
+
+        upload_session = {
+            "bucket": entry["Bucket"],
+            "key": entry["Key"],
+            "uploadId": entry["UploadId"],
+            "StorageNode": entry["StorageNode"],
+        }
+        listed = self._list_uploaded_parts(upload_session)
+        if listed is None:
+            # The session expired or was aborted server-side: start over
+            tqdm.write("Previous upload session is no longer valid, starting over")
+            self.journal.remove(journal_key)
+            return None
+
+        # Only trust parts the server holds with exactly the expected size
+        block_size = entry["blockSize"]
+        done_parts = {
+            part_number for part_number, size in listed.items()
+            if size == min(block_size, file_size - (part_number - 1) * block_size)
+        }
+        self.journal.set_parts(journal_key, done_parts)
+        return entry, block_size, done_parts
 
-                pbar.update(len(data))
-                part_number_start += 1
+    def upload_file(self, file_path, parent_id=None, sure=None, skip_existing=True, md5=None):
+        """Upload a single file to 123Pan Cloud
 
-        tqdm.write("Chunk upload complete, finalizing...")
+        Before hashing, the remote folder listing is checked for a file with
+        the same name and size; only such a candidate needs its MD5 compared.
+        Files that fit in one part and have no cached MD5 are read once into
+        a pooled buffer, hashed from it and uploaded from the same buffer.
 
-        uploaded_comp_data = {
-            "bucket": bucket,
-            "key": upload_key,
-            "uploadId": upload_id,
-            "storageNode": storage_node,
-        }
+        Args:
+            file_path: Path to the file to upload
+            parent_id: Parent folder ID (None for current directory)
+            sure: Duplicate handling strategy - "1":keep both, "2":overwrite
+            skip_existing: If True, skip files that already exist with same MD5 (default: True)
+            md5: Precomputed MD5 of the file (None to hash it here)
+
+        Returns:
+            dict: Upload result with 'success', 'skipped', 'file_name' keys
+        """
+        if not os.path.exists(file_path) or not os.path.isfile(file_path):
+            tqdm.write(f"Error: {file_path} is not a valid file")
+            return {'success': False, 'skipped': False, 'file_name': ''}
+
+        file_path = file_path.replace('"', "").replace("\\", "/")
+        file_name = os.path.basename(file_path)
+        file_stat = os.stat(file_path)
+        file_size = file_stat.st_size
+
+        tqdm.write(f"Preparing to upload: {file_name} ({format_size(file_size)})")
+
+        if parent_id is None:
+            parent_id = self.pan.parentFileId
+        # Only a remote file with the same name and size can be the same file
+        candidate = skip_existing and self.remote_candidate(file_name, file_size, parent_id)
+
+        if md5 is None and not self.rehash:
+            md5 = self.hash_cache.get(file_stat)
+
+        if md5 is None and file_size <= config.DEFAULT_BLOCK_SIZE:
+            # Always a single part: one read serves both the MD5 and the upload
+            with self.buffer_pool.borrow(file_size) as data:
+                with open(file_path, "rb", buffering=0) as f:
+                    if read_exactly(f, data) != file_size:
+                        tqdm.write(f"Error: {file_name} changed while reading")
+                        return {'success': False, 'skipped': False, 'file_name': file_name}
+                md5 = hashlib.md5(data).hexdigest()
+                self.hash_cache.put(file_path, file_stat, md5)
+                return self._upload_hashed(
+                    file_path, file_name, file_size, md5, parent_id, sure, candidate, data
+                )
+
+        if md5 is None:
+            tqdm.write("Calculating file MD5...")
+            md5 = self.compute_file_md5(file_path, self.use_mmap)
+            self.hash_cache.put(file_path, file_stat, md5)
+
+        return self._upload_hashed(file_path, file_name, file_size, md5, parent_id, sure, candidate)
+
+    def remote_candidate(self, file_name, file_size, parent_id):
+        """Check the remote listing for a file that could be identical
 
+        Args:
+            file_name: Name of the local file
+            file_size: Size of the local file in bytes
+            parent_id: Remote parent folder ID
+
+        Returns:
+            bool: True if a remote file has this name and size, so the MD5
+                must be compared; False if the file is definitely new or
+                definitely changed
+        """
         try:
-            list_parts_res = requests.post(
-                config.URL_S3_LIST_PARTS,
-                headers=self.pan.headerLogined,
-                json=uploaded_comp_data,
-                timeout=config.TIMEOUT_MEDIUM
-            )
-            list_parts_json = list_parts_res.json()
-        except requests.exceptions.RequestException as e:
-            tqdm.write(f"Failed to list uploaded parts: {e}")
+            file_info = self.remote_index.find_file(parent_id, file_name)
+        except Exception as e:
+            tqdm.write(f"Warning: Could not check for existing file: {e}")
+            return True
+        return file_info is not None and int(file_info.get("Size", -1)) == file_size
+
+    def _upload_hashed(self, file_path, file_name, file_size, md5, parent_id, sure, candidate, data=None):
+        """Upload a file whose MD5 is known (see upload_file)
+
+        Args:
+            file_path: Normalized path to the local file
+            file_name: Remote file name
+            file_size: Size of the file in bytes
+            md5: MD5 of the file
+            parent_id: Remote parent folder ID
+            sure: Duplicate handling strategy - "1":keep both, "2":overwrite
+            candidate: True if a same-name, same-size remote file should be compared
+            data: File contents already in memory (single-part files), or None
+
+        Returns:
+            dict: Upload result with 'success', 'skipped', 'file_name', 'md5' keys
+        """
+        result = {'success': False, 'skipped': False, 'file_name': file_name, 'md5': md5}
+
+        if candidate and self.check_file_exists_with_md5(file_name, md5, parent_id):
+            tqdm.write(f"Skipped (same MD5 exists): {file_name}")
+            result['success'] = True
+            result['skipped'] = True
             return result
-        except ValueError as e:
-            tqdm.write(f"Failed to parse parts list response: {e}")
+
+        if sure == "2":
+            self._delete_existing(file_name, parent_id)
+
+        journal_key = UploadJournal.make_key(file_path, md5, parent_id)
+        resumed = self._resume_upload(journal_key, file_size)
+
+        if resumed is not None:
+            upload_data, block_size, done_parts = resumed
+            tqdm.write(f"Resuming upload: {file_name} ({len(done_parts)} parts already uploaded)")
+        else:
+            upload_data = self._request_upload(file_name, md5, file_size, parent_id, sure)
+            if upload_data is None:
+                return result
+            if upload_data.get("Reuse"):
+                tqdm.write(f"Upload successful, file MD5 reused: {file_name}")
+                self._index_uploaded(parent_id, file_name, file_size, md5, upload_data)
+                result['success'] = True
+                return result
+
+            block_size = self.choose_block_size(file_size)
+            done_parts = set()
+            # A single-part upload has nothing to resume, so it isn't journaled
+            if file_size > block_size:
+                self.journal.start(journal_key, upload_data, block_size, file_size)
+
+        upload_session = {
+            "bucket": upload_data["Bucket"],
+            "key": upload_data["Key"],
+            "uploadId": upload_data["UploadId"],
+            "StorageNode": upload_data["StorageNode"],
+        }
+        up_file_id = upload_data["FileId"]
+        # Small-file fast path: with one part there is no part state worth
+        # listing, so the part is presigned right after upload_request and
+        # both s3_list_upload_parts calls are skipped
+        single_part = file_size <= block_size
+
+        if resumed is None and not single_part and self._list_uploaded_parts(upload_session) is None:
             return result
 
-        if list_parts_json.get("code") != 0:
-            tqdm.write(f"s3_list_upload_parts failed: {list_parts_json}")
+        with tqdm(
+            total=file_size, unit="B", unit_scale=True, desc=file_name, position=1, leave=False
+        ) as pbar:
+            if not self._upload_parts(
+                file_path, file_size, block_size, upload_session, pbar,
+                done_parts=done_parts,
+                on_part_done=lambda part_number: self.journal.add_part(journal_key, part_number),
+                data=data
+            ):
+                self.journal.flush()
+                return result
+
+        tqdm.write("Chunk upload complete, finalizing...")
+
+        if not single_part and self._list_uploaded_parts(upload_session) is None:
             return result
 
+        finalize_started = time.monotonic()
+        uploaded_comp_data = {
+            "bucket": upload_session["bucket"],
+            "key": upload_session["key"],
+            "uploadId": upload_session["uploadId"],
+            "storageNode": upload_session["StorageNode"],
+        }
+
         try:
-            comp_res = requests.post(
+            comp_res = self.pan.session.post(
                 config.URL_S3_COMPLETE_MULTIPART,
                 headers=self.pan.headerLogined,
                 json=uploaded_comp_data,
@@ -346,33 +844,246 @@ class MPush:
             tqdm.write(f"s3_complete_multipart_upload failed: {comp_json}")
             return result
 
-        if file_size > 64 * 1024 * 1024:
-            time.sleep(3)
+        if not self._complete_upload(up_file_id):
+            return result
+
+        finalize_seconds = time.monotonic() - finalize_started
+        self.finalize_times.record(finalize_seconds)
+        tqdm.write(f"Upload successful: {file_name} (finalized in {finalize_seconds:.1f}s)")
+        self.journal.remove(journal_key)
+        self._index_uploaded(parent_id, file_name, file_size, md5, upload_data)
+        result['success'] = True
+        return result
+
+    def _complete_upload(self, up_file_id):
+        """Call upload_complete, polling until the server has assembled the file
+
+        Right after s3_complete_multipart_upload a large object may still be
+        merging on the server. Instead of sleeping a fixed time, upload_complete
+        is retried with short exponential backoff (FINALIZE_POLL_INITIAL up to
+        FINALIZE_POLL_MAX seconds) until it succeeds or FINALIZE_DEADLINE passes.
+        Only transport errors and responses saying the file is still being
+        merged (see FINALIZE_PENDING_HINTS) are polled; any other error code
+        fails the upload at once.
+
+        Args:
+            up_file_id: FileId from the upload_request response
+
+        Returns:
+            bool: True if the upload was registered
+        """
+        deadline = time.monotonic() + config.FINALIZE_DEADLINE
+        delay = config.FINALIZE_POLL_INITIAL
+        while True:
+            try:
+                close_up_session_res = self.pan.session.post(
+                    config.URL_UPLOAD_COMPLETE,
+                    headers=self.pan.headerLogined,
+                    json={"fileId": up_file_id},
+                    timeout=config.TIMEOUT_MEDIUM
+                )
+                close_res_json = close_up_session_res.json()
+                if close_res_json.get("code") == 0:
+                    return True
+                error = close_res_json
+                if not self._still_merging(close_res_json):
+                    tqdm.write(f"Upload failed: {error}")
+                    return False
+            except requests.exceptions.RequestException as e:
+                error = f"request failed: {e}"
+            except ValueError as e:
+                error = f"parse failed: {e}"
+
+            if time.monotonic() + delay > deadline:
+                tqdm.write(f"Upload failed: {error}")
+                return False
+            time.sleep(delay)
+            delay = min(delay * 2, config.FINALIZE_POLL_MAX)
 
-        close_up_session_data = {"fileId": up_file_id}
+    @staticmethod
+    def _still_merging(response_json):
+        """Return True if an upload_complete error says the file isn't assembled yet"""
+        message = str(response_json.get("message", "")).lower()
+        return any(hint in message for hint in config.FINALIZE_PENDING_HINTS)
+
+    def _ensure_folder(self, parent_id, name):
+        """Return the ID of a remote sub-folder, creating it if it doesn't exist
+
+        Looks the name up in the shared folder index instead of relisting the
+        parent, and paces creations through the shared mkdir rate limiter.
+        A created folder is indexed as empty, so lookups inside it never
+        list it. Safe to call from worker threads.
+
+        Args:
+            parent_id: Remote parent folder ID
+            name: Folder name
+
+        Returns:
+            int: Folder ID, or None on failure
+        """
+        existing = self.remote_index.find_folder(parent_id, name)
+        if existing is not None:
+            return existing["FileId"]
+
+        self.mkdir_limiter.acquire()
+        info = self.pan.create_folder(name, parent_id)
+        if info is None:
+            return None
+        self.remote_index.add(parent_id, info)
+        self.remote_index.add_empty(info["FileId"])
+        return info["FileId"]
+
+    @staticmethod
+    def _iter_local_dir(path, file_types):
+        """Stream the entries of one local directory without listing it first
 
+        Mirrors os.walk: symlinks to directories are not descended into.
+
+        Yields:
+            tuple: (is_dir, path) for each matching file and sub-directory
+        """
         try:
-            close_up_session_res = requests.post(
-                config.URL_UPLOAD_COMPLETE,
-                headers=self.pan.headerLogined,
-                json=close_up_session_data,
-                timeout=config.TIMEOUT_MEDIUM
-            )
-            close_res_json = close_up_session_res.json()
-        except requests.exceptions.RequestException as e:
-            tqdm.write(f"Upload complete request failed: {e}")
-            return result
-        except ValueError as e:
-            tqdm.write(f"Upload complete parse failed: {e}")
-            return result
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir():
+                            if not entry.is_symlink():
+                                yield True, entry.path.replace("\\", "/")
+                            continue
+                    except OSError:
+                        continue
+                    if file_types and not any(entry.name.endswith(ft) for ft in file_types):
+                        continue
+                    yield False, entry.path.replace("\\", "/")
+        except OSError as e:
+            tqdm.write(f"Error reading directory {path}: {e}")
+
+    def _create_folder_tree(self, dir_path, root_id, file_types, emit, stop):
+        """Mirror a local directory tree remotely, level by level
+
+        All sub-folders of one level are created concurrently (paced by the
+        shared mkdir limiter, with a bounded number of creations queued), and
+        each folder's files are streamed to emit as soon as that folder
+        exists, so uploads start before the tree is complete. Only the
+        directories of the next level are held in memory, never file lists.
 
-        if close_res_json.get("code") == 0:
-            tqdm.write(f"Upload successful: {file_name}")
-            result['success'] = True
-            return result
-        else:
-            tqdm.write(f"Upload failed: {close_res_json}")
-            return result
+        Args:
+            dir_path: Local root directory
+            root_id: Remote folder ID corresponding to dir_path
+            file_types: List of file extensions to include (None for all)
+            emit: Callback(file_path, folder_id) for every file to upload;
+                may block to apply back-pressure
+            stop: threading.Event set when the upload is abandoned
+        """
+        skip_dirs = ["venv", ".idea", "__pycache__", ".git", "node_modules"]
+        next_level = []
+
+        def enter(local_path, folder_id):
+            for is_dir, path in self._iter_local_dir(local_path, file_types):
+                if stop.is_set():
+                    return
+                if not is_dir:
+                    emit(path, folder_id)
+                elif not any(skip_dir in path for skip_dir in skip_dirs):
+                    next_level.append((path, folder_id))
+
+        def created(future):
+            local_path = futures.pop(future)
+            try:
+                sub_folder_id = future.result()
+            except Exception as e:
+                tqdm.write(f"Error creating directory {local_path}: {e}")
+                sub_folder_id = None
+            if not sub_folder_id:
+                tqdm.write(f"Failed to create directory {local_path}, skipping its contents")
+                return
+            tqdm.write(f"Created directory: {os.path.basename(local_path)}, ID: {sub_folder_id}")
+            enter(local_path, sub_folder_id)
+
+        def settle(limit):
+            # Handle finished creations until at most limit are pending
+            while len(futures) > limit and not stop.is_set():
+                done, _ = wait(futures, timeout=0.5, return_when=FIRST_COMPLETED)
+                for future in done:
+                    created(future)
+
+        if any(skip_dir in dir_path for skip_dir in skip_dirs):
+            return
+        enter(dir_path, root_id)
+
+        futures = {}
+        window = config.MKDIR_WORKERS * 4
+        with ThreadPoolExecutor(max_workers=config.MKDIR_WORKERS) as executor:
+            while next_level and not stop.is_set():
+                level, next_level = next_level, []
+                for local_path, parent_folder_id in level:
+                    settle(window - 1)
+                    if stop.is_set():
+                        break
+                    future = executor.submit(self._ensure_folder, parent_folder_id, os.path.basename(local_path))
+                    futures[future] = local_path
+                settle(0)
+            # Don't create folders that were queued before the upload was abandoned
+            for future in futures:
+                future.cancel()
+
+    def _hash_stage(self, todo, hashed, stop, seen_sizes):
+        """Hashing worker: hash queued files and pass them to the upload stage
+
+        Runs until it takes a None sentinel from todo or stop is set, then
+        puts a None end marker on hashed (also if it fails, so the consumer
+        never waits for a worker that is gone). Blocks while the bounded hashed
+        queue is full, so hashing never runs far ahead of the uploads.
+        Single-part files without a cached MD5 are passed on unhashed, and
+        upload_file hashes them from the buffer it uploads from, unless
+        another file of the same size was seen: those are hashed here so
+        identical copies can be grouped.
+
+        Args:
+            todo: queue.Queue of (file_path, folder_id) tuples, None to stop
+            hashed: Bounded queue.Queue receiving (file_path, folder_id, size, md5);
+                md5 is None if the file could not be hashed, or
+                HASH_ON_UPLOAD if hashing was left to upload_file
+            stop: threading.Event set when the upload is abandoned
+            seen_sizes: RecentKeys of file sizes seen so far, shared by the hashing workers
+        """
+        try:
+            while not stop.is_set():
+                try:
+                    item = todo.get(timeout=0.5)
+                except queue.Empty:
+                    continue
+                if item is None:
+                    break
+                file_path, folder_id = item
+                size = None
+                try:
+                    file_stat = os.stat(file_path)
+                    size = file_stat.st_size
+                    repeated = seen_sizes.add(size)
+                    md5 = None if self.rehash else self.hash_cache.get(file_stat)
+                    if md5 is None:
+                        if size <= config.DEFAULT_BLOCK_SIZE and not repeated:
+                            md5 = HASH_ON_UPLOAD
+                        else:
+                            md5 = self.get_file_md5(file_path)
+                except Exception as e:
+                    tqdm.write(f"Error hashing {file_path}: {e}")
+                    md5 = None
+                self._put_until_stopped(hashed, (file_path, folder_id, size, md5), stop)
+        finally:
+            self._put_until_stopped(hashed, None, stop)
+
+    @staticmethod
+    def _put_until_stopped(q, item, stop):
+        """Put an item on a bounded queue, giving up if stop is set"""
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
 
     def upload_directory_concurrent(
         self,
@@ -383,12 +1094,22 @@ class MPush:
         sure=None,
         custom_dirname=None,
         skip_existing=True,
+        hash_workers=None,
     ):
         """Upload a directory to 123Pan Cloud using concurrent threads
 
-        This method uploads an entire directory structure to 123Pan Cloud.
-        It first creates the remote directory structure, then uploads files
-        concurrently using a thread pool. Displays overall progress with tqdm.
+        This method uploads an entire directory structure to 123Pan Cloud as a
+        streaming pipeline. Three stages run concurrently, connected by
+        bounded queues: a folder creator mirrors the tree level by level and
+        streams each folder's files as soon as the folder exists, a hashing
+        pool computes MD5s, and an upload pool uploads files as soon as they
+        are hashed, with a bounded number of uploads submitted at once.
+        Files with identical content (same size and MD5) are uploaded once:
+        later copies are held back until the first finishes, then sent as
+        instant (MD5 reuse) uploads. Held-back copies count toward the
+        bounded number of uploads, so they apply back-pressure too. Neither the file list nor per-file futures are ever materialized, so
+        time to first upload and memory use do not grow with the tree.
+        Displays overall progress with tqdm.
 
         Args:
             dir_path: Local path to the directory to upload
@@ -398,6 +1119,7 @@ class MPush:
             sure: Duplicate handling strategy - "1":keep both, "2":overwrite
             custom_dirname: Custom name for the remote directory (default: use local name)
             skip_existing: If True, skip files that already exist with same MD5 (default: True)
+            hash_workers: Number of concurrent hashing threads (default: config.DEFAULT_HASH_WORKERS)
 
         Returns:
             bool: True if upload successful, False otherwise
@@ -414,82 +1136,195 @@ class MPush:
         if parent_id is None:
             parent_id = self.pan.parentFileId
 
-        folder_id = self.pan.mkdir(dir_name, parent_id, remake=False)
+        folder_id = self._ensure_folder(parent_id, dir_name)
         if not folder_id:
             print(f"Failed to create directory {dir_name}")
             return False
 
         print(f"Directory created: {dir_name}, ID: {folder_id}")
 
-        mkdir_list = {dir_path: folder_id}
-        skip_dirs = ["venv", ".idea", "__pycache__", ".git", "node_modules"]
-
-        files_to_upload = []
-
-        for filepath, dirnames, filenames in os.walk(dir_path):
-            if any(skip_dir in filepath for skip_dir in skip_dirs):
-                continue
-
-            parent_path = os.path.dirname(filepath)
-            if parent_path in mkdir_list and filepath != dir_path:
-                sub_dir_name = os.path.basename(filepath)
-                parent_folder_id = mkdir_list[parent_path]
-                sub_folder_id = self.pan.mkdir(sub_dir_name, parent_folder_id, remake=False)
-                time.sleep(0.2)
-                if sub_folder_id:
-                    mkdir_list[filepath] = sub_folder_id
-                    tqdm.write(f"Created directory: {sub_dir_name}, ID: {sub_folder_id}")
-
-            if filepath in mkdir_list:
-                current_folder_id = mkdir_list[filepath]
-                for filename in filenames:
-                    if file_types:
-                        if not any(filename.endswith(ft) for ft in file_types):
-                            continue
-                    file_path = os.path.join(filepath, filename)
-                    files_to_upload.append((file_path, current_folder_id))
-
-        total_files = len(files_to_upload)
+        total_files = 0
         uploaded_count = 0
         skipped_count = 0
         failed_count = 0
 
-        with tqdm(total=total_files, desc="Overall Progress", position=0, unit="file") as overall_pbar:
-            with ThreadPoolExecutor(max_workers=max_workers) as executor:
-                futures = {}
-                for file_path, target_folder_id in files_to_upload:
-                    # Capture target_folder_id at submission time (not late binding)
-                    future = executor.submit(
-                        self.upload_file, file_path, target_folder_id, sure, skip_existing
-                    )
-                    futures[future] = file_path
+        hash_workers = hash_workers or config.DEFAULT_HASH_WORKERS
+        self.finalize_times = DurationStats()
+        # With auto-concurrency the controller decides how many uploads run
+        file_workers = self.concurrency.maximum if self.concurrency else max_workers
+        part_workers = self.concurrency.maximum if self.concurrency else file_workers * self.part_workers
+        # Each upload worker makes API calls and has a presign prefetcher
+        self.pan.ensure_pool_size(file_workers * 2 + config.MKDIR_WORKERS, part_workers)
+        todo = queue.Queue(maxsize=config.WALK_QUEUE_SIZE)
+        hashed = queue.Queue(maxsize=config.HASH_QUEUE_SIZE)
+        stop = threading.Event()
+        discovered = [0]
+
+        def emit(file_path, target_folder_id):
+            if self._put_until_stopped(todo, (file_path, target_folder_id), stop):
+                discovered[0] += 1
+
+        def walk():
+            try:
+                self._create_folder_tree(dir_path, folder_id, file_types, emit, stop)
+            finally:
+                for _ in range(hash_workers):
+                    self._put_until_stopped(todo, None, stop)
+
+        def dispatch(item):
+            # Submit an upload, or hold it back while a file it may be a copy
+            # of is still uploading, so the copy can reuse the uploaded blob
+            file_path, target_folder_id, size, md5 = item
+            if md5 is HASH_ON_UPLOAD:
+                key, md5 = None, None
+            else:
+                key = (size, md5)
+            nonlocal held
+            if unhashed_sending.get(size):
+                waiting.setdefault(size, []).append(item)
+                held += 1
+                return
+            if key in sending_keys:
+                waiting.setdefault(key, []).append(item)
+                held += 1
+                return
+            copy = key in uploaded_keys
+            if key is None:
+                unhashed_sending[size] = unhashed_sending.get(size, 0) + 1
+            elif not copy:
+                sending_keys.add(key)
+            future = executor.submit(
+                self.upload_file, file_path, target_folder_id, sure, skip_existing, md5
+            )
+            in_flight[future] = (file_path, size, key, copy)
 
-                for future in as_completed(futures):
-                    file_path = futures[future]
+        def record(future):
+            nonlocal uploaded_count, skipped_count, failed_count, duplicate_count
+            file_path, size, key, copy = in_flight.pop(future)
+            result = {}
+            try:
+                result = future.result()
+                if result.get('success'):
+                    if result.get('skipped'):
+                        skipped_count += 1
+                    else:
+                        uploaded_count += 1
+                        duplicate_count += copy
+                else:
+                    failed_count += 1
+            except Exception as e:
+                tqdm.write(f"Error uploading {file_path}: {e}")
+                failed_count += 1
+            advance()
+
+            # Release the copies held back for this upload (submitted by pump()
+            # as the window allows); if it failed, the first of them becomes
+            # the new upload and the rest wait again
+            if key is None:
+                unhashed_sending[size] -= 1
+                if result.get('success'):
+                    uploaded_keys.add((size, result['md5']))
+                if not unhashed_sending[size]:
+                    del unhashed_sending[size]
+                    ready.extend(waiting.pop(size, ()))
+            else:
+                sending_keys.discard(key)
+                if result.get('success'):
+                    uploaded_keys.add(key)
+                ready.extend(waiting.pop(key, ()))
+
+        def window():
+            # Uploads submitted or held back at once; bounding both keeps the
+            # hashed queue (and therefore the hashing pool) applying back-pressure
+            return (self.concurrency.limit if self.concurrency else max_workers) * 2
+
+        def pump():
+            # Submit released copies while the window has room
+            nonlocal held
+            while ready and len(in_flight) < window():
+                held -= 1
+                dispatch(ready.popleft())
+
+        def collect(block):
+            # Record finished uploads (waiting for one if block is set)
+            pump()
+            if not in_flight:
+                return
+            done, _ = wait(in_flight, timeout=None if block else 0, return_when=FIRST_COMPLETED)
+            for future in done:
+                record(future)
+            pump()
+
+        def advance():
+            overall_pbar.total = discovered[0]
+            overall_pbar.update(1)
+            overall_pbar.set_postfix(
+                uploaded=uploaded_count,
+                skipped=skipped_count,
+                failed=failed_count
+            )
+
+        in_flight = {}
+        seen_sizes = RecentKeys()
+        sending_keys = set()     # (size, md5) of files being uploaded
+        uploaded_keys = RecentKeys()  # (size, md5) of files recently uploaded
+        unhashed_sending = {}    # size -> uploads in flight whose MD5 isn't known yet
+        waiting = {}             # (size, md5) or size -> items held back for that upload
+        ready = deque()          # held-back items released, waiting for room in the window
+        held = 0                 # items in waiting and ready
+        duplicate_count = 0
+
+        with tqdm(total=0, desc="Overall Progress", position=0, unit="file") as overall_pbar, \
+                ThreadPoolExecutor(max_workers=hash_workers + 1) as stage_executor, \
+                ThreadPoolExecutor(max_workers=file_workers) as executor:
+            stage_executor.submit(walk)
+            for _ in range(hash_workers):
+                stage_executor.submit(self._hash_stage, todo, hashed, stop, seen_sizes)
+
+            try:
+                finished_hashers = 0
+                while finished_hashers < hash_workers:
+                    # Record uploads as they finish, so held-back copies are
+                    # released promptly even while hashing is slow
+                    collect(block=False)
+                    while len(in_flight) + held >= window() and (in_flight or ready):
+                        collect(block=True)
                     try:
-                        result = future.result()
-                        if result.get('success'):
-                            if result.get('skipped'):
-                                skipped_count += 1
-                            else:
-                                uploaded_count += 1
-                        else:
-                            failed_count += 1
-                    except Exception as e:
-                        tqdm.write(f"Error uploading {file_path}: {e}")
+                        item = hashed.get(timeout=0.1)
+                    except queue.Empty:
+                        continue
+                    if item is None:
+                        finished_hashers += 1
+                        continue
+                    if item[3] is None:
                         failed_count += 1
-
-                    overall_pbar.update(1)
-                    overall_pbar.set_postfix(
-                        uploaded=uploaded_count,
-                        skipped=skipped_count,
-                        failed=failed_count
-                    )
+                        advance()
+                        continue
+                    dispatch(item)
+                # Every hashing worker is gone; if one failed, the walker may
+                # still be blocked on the todo queue nobody reads any more
+                stop.set()
+
+                # Finishing uploads release held-back copies into in_flight
+                while in_flight or ready:
+                    collect(block=True)
+            except BaseException:
+                # Release the walker and hashing workers blocked on full queues
+                stop.set()
+                raise
+
+        total_files = discovered[0]
+        self.hash_cache.flush()
 
         print(f"\nDirectory upload completed")
         print(f"  Total files: {total_files}")
         print(f"  Uploaded: {uploaded_count}")
         print(f"  Skipped (same MD5): {skipped_count}")
+        if duplicate_count:
+            print(f"  Identical copies (instant upload): {duplicate_count}")
         print(f"  Failed: {failed_count}")
+        finalize_summary = self.finalize_times.summary()
+        if finalize_summary:
+            print(f"  Finalize time: {finalize_summary}")
 
         return failed_count == 0
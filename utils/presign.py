@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+import requests
+from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
+from tosasitill_123pan import config
+
+
+class PresignedUrlPool:
+    """Batched, prefetching cache of presigned part upload URLs
+
+    The s3_repare_upload_parts_batch endpoint returns presigned URLs for a
+    whole range of part numbers. This pool requests them in aligned batches,
+    remembers when each batch was fetched so stale URLs are refreshed, and
+    fetches the next batch in the background while the current one is being
+    uploaded, so part PUTs never wait on presigning.
+
+    Thread-safe: get() may be called from any number of part workers.
+    """
+
+    def __init__(self, pan, upload_session, total_parts, batch_size=None, ttl=None):
+        """Initialize the pool for one multipart upload
+
+        Args:
+            pan: Authenticated Pan123 instance for API calls
+            upload_session: Dict with bucket, key, uploadId and StorageNode
+            total_parts: Number of parts in the upload
+            batch_size: Parts per presign request (default: config.PRESIGN_BATCH_SIZE)
+            ttl: Seconds a presigned URL is trusted (default: config.PRESIGN_URL_TTL)
+        """
+        self.pan = pan
+        self.upload_session = upload_session
+        self.total_parts = total_parts
+        self.batch_size = batch_size or config.PRESIGN_BATCH_SIZE
+        self.ttl = ttl or config.PRESIGN_URL_TTL
+        self.api_calls = 0
+
+        self._cond = threading.Condition()
+        self._urls = {}          # part number -> presigned URL
+        self._fetched_at = {}    # batch start -> time.monotonic() of fetch
+        self._in_flight = set()  # batch starts currently being fetched
+        self._prefetcher = ThreadPoolExecutor(max_workers=1)
+
+    def _batch_start(self, part_number):
+        return (part_number - 1) // self.batch_size * self.batch_size + 1
+
+    def _is_fresh(self, batch_start):
+        fetched_at = self._fetched_at.get(batch_start)
+        return fetched_at is not None and time.monotonic() - fetched_at < self.ttl
+
+    def _fetch_batch(self, batch_start):
+        """Request presigned URLs for one batch (called without the lock held)
+
+        Returns:
+            dict: Part number -> URL, or None on failure
+        """
+        batch_end = min(batch_start + self.batch_size, self.total_parts + 1)
+        get_link_data = dict(self.upload_session)
+        get_link_data["partNumberStart"] = batch_start
+        get_link_data["partNumberEnd"] = batch_end
+
+        try:
+            get_link_res = self.pan.session.post(
+                config.URL_S3_PREPARE_PARTS,
+                headers=self.pan.headerLogined,
+                json=get_link_data,
+                timeout=config.TIMEOUT_MEDIUM
+            )
+            get_link_res_json = get_link_res.json()
+        except requests.exceptions.RequestException as e:
+            tqdm.write(f"Failed to get upload links: {e}")
+            return None
+        except ValueError as e:
+            tqdm.write(f"Failed to parse upload link response: {e}")
+            return None
+
+        if get_link_res_json.get("code") != 0:
+            tqdm.write(f"Failed to get upload links: {get_link_res_json}")
+            return None
+
+        presigned = get_link_res_json["data"]["presignedUrls"]
+        return {int(part): url for part, url in presigned.items()}
+
+    def _load(self, batch_start):
+        """Fetch a batch unless it is fresh or another thread is fetching it
+
+        Returns:
+            bool: False only if this call fetched the batch and the fetch failed
+        """
+        with self._cond:
+            while batch_start in self._in_flight:
+                self._cond.wait()
+            if self._is_fresh(batch_start):
+                return True
+            self._in_flight.add(batch_start)
+
+        urls = None
+        try:
+            urls = self._fetch_batch(batch_start)
+        finally:
+            with self._cond:
+                self._in_flight.discard(batch_start)
+                self.api_calls += 1
+                if urls:
+                    self._urls.update(urls)
+                    self._fetched_at[batch_start] = time.monotonic()
+                self._cond.notify_all()
+        return urls is not None
+
+    def _prefetch_after(self, batch_start):
+        next_start = batch_start + self.batch_size
+        if next_start > self.total_parts:
+            return
+        with self._cond:
+            if next_start in self._in_flight or self._is_fresh(next_start):
+                return
+        self._prefetcher.submit(self._load, next_start)
+
+    def get(self, part_number):
+        """Return the presigned URL for a part, fetching its batch if needed
+
+        Also schedules the following batch in the background.
+
+        Args:
+            part_number: 1-based part number
+
+        Returns:
+            str: Presigned URL, or None if presigning failed
+        """
+        batch_start = self._batch_start(part_number)
+        with self._cond:
+            fresh = self._is_fresh(batch_start) and part_number in self._urls
+        if not fresh:
+            self._load(batch_start)
+        self._prefetch_after(batch_start)
+
+        with self._cond:
+            return self._urls.get(part_number) if self._is_fresh(batch_start) else None
+
+    def invalidate(self, part_number, url):
+        """Forget a presigned URL that the storage node rejected (e.g. expired)
+
+        The next get() for any part of its batch fetches the batch again. If
+        the batch was already refetched since `url` was handed out, nothing
+        is discarded, so concurrent failures cause a single refetch.
+
+        Args:
+            part_number: 1-based part number
+            url: The URL that failed
+        """
+        with self._cond:
+            if self._urls.get(part_number) == url:
+                self._fetched_at.pop(self._batch_start(part_number), None)
+
+    def close(self):
+        """Stop the background prefetcher"""
+        self._prefetcher.shutdown(wait=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+from collections import deque
+from tosasitill_123pan import config
+
+
+class Segment:
+    """Byte range of a download handed to one worker
+
+    `position` is the next byte to claim and `end` the last byte (inclusive).
+    `end` shrinks when an idle worker splits off the second half.
+    """
+
+    __slots__ = ("index", "start", "position", "end", "retries", "not_before")
+
+    def __init__(self, index, start, end, retries=0, not_before=0.0):
+        self.index = index      # range index in the DownloadState
+        self.start = start
+        self.position = start
+        self.end = end
+        self.retries = retries  # times the bytes of this segment were requested again
+        self.not_before = not_before  # time.monotonic() before which it is not handed out
+
+    @property
+    def remaining(self):
+        return self.end - self.position + 1
+
+
+class RangeScheduler:
+    """Hands out download segments on demand, with work stealing
+
+    Workers take the unfinished ranges of a DownloadState one at a time.
+    Once none are left, an idle worker splits the in-flight segment with the
+    most bytes remaining: it takes the second half, and the worker that held
+    the segment stops at the new end. A slow connection therefore never
+    holds a large tail of the file alone, and the last bytes finish in about
+    the time of one small segment. Segments smaller than twice
+    DOWNLOAD_MIN_SPLIT are not split.
+
+    Workers claim() bytes before writing them and report them with
+    written() afterwards, so a split never hands out bytes that are
+    already being written. A segment that failed on congestion is queued
+    again with retry() and handed out to any worker once its backoff has
+    passed; workers wait for it instead of exiting. Thread-safe.
+    """
+
+    def __init__(self, state, min_split=None, segment_size=None):
+        """Initialize the scheduler
+
+        Args:
+            state: DownloadState whose remaining ranges are to be downloaded
+            min_split: Smallest segment split off (default: config.DOWNLOAD_MIN_SPLIT)
+            segment_size: If given, remaining ranges are cut into segments of
+                at most this many bytes (recorded as ranges of the state), so
+                the bytes being written at any time stay close together
+        """
+        self._state = state
+        self._min_split = min_split or config.DOWNLOAD_MIN_SPLIT
+        self._lock = threading.Lock()
+        remaining = state.remaining()
+        if segment_size:
+            remaining = self._cut(state, remaining, segment_size)
+        # Hand segments out in file order
+        self._pending = deque(
+            Segment(i, start, end) for i, start, end in sorted(remaining, key=lambda r: r[1])
+        )
+        self._active = set()
+        self._cancelled = False
+        self.written_bytes = 0
+        self.splits = 0
+
+    @staticmethod
+    def _cut(state, remaining, segment_size):
+        segments = []
+        for index, start, end in remaining:
+            while end - start + 1 > segment_size:
+                next_index = state.split(index, start + segment_size)
+                segments.append((index, start, start + segment_size - 1))
+                index, start = next_index, start + segment_size
+            segments.append((index, start, end))
+        return segments
+
+    def next(self):
+        """Get the next segment to download
+
+        If the only segments left are retries still backing off, an
+        in-flight segment is split instead, or the call waits for the
+        earliest retry to become due.
+
+        Returns:
+            Segment, or None when nothing is pending and nothing is worth splitting
+        """
+        while True:
+            with self._lock:
+                if self._cancelled:
+                    return None
+                now = time.monotonic()
+                for segment in self._pending:
+                    if segment.not_before <= now:
+                        self._pending.remove(segment)
+                        self._active.add(segment)
+                        return segment
+                segment = self._split()
+                if segment is not None or not self._pending:
+                    return segment
+                delay = min(s.not_before for s in self._pending) - now
+            time.sleep(min(delay, 0.5))
+
+    def _split(self):
+        # Caller holds self._lock
+        victim = max(self._active, key=lambda s: s.remaining, default=None)
+        if victim is None or victim.remaining < 2 * self._min_split:
+            return None
+        mid = victim.position + victim.remaining // 2
+        segment = Segment(self._state.split(victim.index, mid), mid, victim.end)
+        victim.end = mid - 1
+        self._active.add(segment)
+        self.splits += 1
+        return segment
+
+    def claim(self, segment, num_bytes):
+        """Reserve the next bytes of a segment before writing them
+
+        Args:
+            segment: Segment being downloaded
+            num_bytes: Bytes received
+
+        Returns:
+            int: How many of them still belong to the segment (0 once it is
+            complete, was split off, or the download was cancelled)
+        """
+        with self._lock:
+            if self._cancelled:
+                return 0
+            num_bytes = max(0, min(num_bytes, segment.remaining))
+            segment.position += num_bytes
+            return num_bytes
+
+    def written(self, segment, num_bytes):
+        """Record claimed bytes as written to the output file"""
+        self._state.advance(segment.index, num_bytes)
+        with self._lock:
+            self.written_bytes += num_bytes
+
+    def retry(self, segment, delay=0):
+        """Queue the unclaimed rest of a failed segment to be downloaded again
+
+        Args:
+            segment: Segment whose download failed (its retries count is
+                carried over, so callers can cap the attempts)
+            delay: Seconds before any worker may take it (the backoff)
+        """
+        with self._lock:
+            self._active.discard(segment)
+            if self._cancelled or segment.remaining <= 0:
+                return
+            self._pending.appendleft(Segment(
+                segment.index, segment.position, segment.end,
+                segment.retries + 1, time.monotonic() + delay
+            ))
+
+    def finish(self, segment):
+        """Stop tracking a segment (complete or failed)"""
+        with self._lock:
+            self._active.discard(segment)
+
+    def cancel(self):
+        """Make workers stop after their current chunk"""
+        with self._lock:
+            self._cancelled = True
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+
+
+class TokenBucket:
+    """Thread-safe token bucket rate limiter
+
+    Tokens refill continuously at `rate` per second up to `burst`, and the
+    bucket starts full so the first `burst` calls don't wait. acquire()
+    blocks until enough tokens are available, so callers sharing a bucket
+    are jointly limited to `rate` on average. A rate of None (or 0) means
+    unlimited: acquire() returns immediately without taking the lock.
+    """
+
+    def __init__(self, rate=None, burst=None):
+        """Initialize the bucket
+
+        Args:
+            rate: Tokens per second (None or 0 for unlimited)
+            burst: Bucket capacity (default: one second worth of tokens)
+        """
+        self._lock = threading.Lock()
+        self.rate = None
+        self.burst = None
+        self._tokens = 0.0
+        self._updated = time.monotonic()
+        self.set_rate(rate, burst)
+        self._tokens = float(self.burst or 0)
+
+    def set_rate(self, rate, burst=None):
+        """Change the rate (and capacity) at runtime
+
+        Args:
+            rate: Tokens per second (None or 0 for unlimited)
+            burst: Bucket capacity (default: one second worth of tokens)
+        """
+        with self._lock:
+            self.rate = rate or None
+            self.burst = (burst or rate or 0) or None
+            self._tokens = min(self._tokens, self.burst or 0.0)
+            self._updated = time.monotonic()
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, tokens=1):
+        """Take tokens from the bucket, sleeping until they are available
+
+        Requests larger than the burst size are allowed; they drive the bucket
+        negative and later callers wait for it to refill.
+
+        Args:
+            tokens: Number of tokens to take
+        """
+        if self.rate is None:
+            return
+        with self._lock:
+            if self.rate is None:
+                return
+            now = time.monotonic()
+            self._refill(now)
+            self._tokens -= tokens
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+from tosasitill_123pan import config
+
+
+class RemoteFolderIndex:
+    """Thread-safe in-memory index of remote folder listings
+
+    Each folder is listed once with Pan123.list_dir() and kept as
+    name -> file info maps (separately for files and folders), so existence
+    checks from concurrent upload workers are dictionary lookups instead of
+    a full get_dir() per file. Uploads and deletions update the index in
+    place. A folder is relisted after config.REMOTE_INDEX_TTL seconds so
+    changes made elsewhere are eventually seen.
+    """
+
+    def __init__(self, pan):
+        """Initialize an empty index
+
+        Args:
+            pan: Authenticated Pan123 instance used to list folders
+        """
+        self.pan = pan
+        self._lock = threading.Lock()
+        self._folders = {}       # folder id -> {"files": {...}, "folders": {...}, "loaded_at": t}
+        self._load_locks = {}    # folder id -> lock held while that folder is listed
+
+    def _load_lock(self, folder_id):
+        with self._lock:
+            return self._load_locks.setdefault(folder_id, threading.Lock())
+
+    def _fresh(self, folder_id):
+        entry = self._folders.get(folder_id)
+        return entry is not None and time.monotonic() - entry["loaded_at"] < config.REMOTE_INDEX_TTL
+
+    def load(self, folder_id):
+        """Make sure a folder's listing is indexed (lists it at most once at a time)
+
+        Args:
+            folder_id: Remote folder ID
+
+        Returns:
+            bool: True if the folder is indexed, False if listing failed
+        """
+        with self._lock:
+            if self._fresh(folder_id):
+                return True
+        with self._load_lock(folder_id):
+            with self._lock:
+                if self._fresh(folder_id):
+                    return True
+            code, items = self.pan.list_dir(folder_id)
+            if code != 0:
+                return False
+            entry = {"files": {}, "folders": {}, "loaded_at": time.monotonic()}
+            for item in items:
+                kind = "folders" if item["Type"] == 1 else "files"
+                entry[kind][item["FileName"]] = item
+            with self._lock:
+                self._folders[folder_id] = entry
+            return True
+
+    def _find(self, folder_id, name, kind):
+        if not self.load(folder_id):
+            return None
+        with self._lock:
+            entry = self._folders.get(folder_id)
+            return entry[kind].get(name) if entry else None
+
+    def find_file(self, folder_id, name):
+        """Return the info dict of a file in a folder, or None"""
+        return self._find(folder_id, name, "files")
+
+    def find_folder(self, folder_id, name):
+        """Return the info dict of a sub-folder in a folder, or None"""
+        return self._find(folder_id, name, "folders")
+
+    def add(self, folder_id, info):
+        """Record a file or folder created in an indexed folder
+
+        Args:
+            folder_id: Remote parent folder ID
+            info: Dict with at least FileName and Type (plus FileId, Size, Etag)
+        """
+        kind = "folders" if info.get("Type") == 1 else "files"
+        with self._lock:
+            entry = self._folders.get(folder_id)
+            if entry is not None:
+                entry[kind][info["FileName"]] = info
+
+    def add_empty(self, folder_id):
+        """Index a folder that was just created as empty, so it is never listed
+
+        Args:
+            folder_id: Remote ID of the new folder
+        """
+        with self._lock:
+            self._folders[folder_id] = {"files": {}, "folders": {}, "loaded_at": time.monotonic()}
+
+    def remove(self, folder_id, name, is_folder=False):
+        """Forget a file or folder that was deleted"""
+        kind = "folders" if is_folder else "files"
+        with self._lock:
+            entry = self._folders.get(folder_id)
+            if entry is not None:
+                entry[kind].pop(name, None)
+
+    def invalidate(self, folder_id=None):
+        """Drop one folder (or every folder if folder_id is None) from the index"""
+        with self._lock:
+            if folder_id is None:
+                self._folders.clear()
+            else:
+                self._folders.pop(folder_id, None)
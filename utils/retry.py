@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import random
+import threading
+
+
+def backoff_delay(attempt, base, cap):
+    """Jittered exponential backoff ("full jitter")
+
+    Args:
+        attempt: 1-based retry number
+        base: Delay scale of the first retry in seconds
+        cap: Upper bound on the delay in seconds
+
+    Returns:
+        float: Seconds to wait, uniformly drawn from [0, min(cap, base * 2**(attempt-1))]
+    """
+    return random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
+
+
+class RetryBudget:
+    """Thread-safe count of retries still allowed
+
+    Budgets can be chained: taking a retry from a per-file budget also takes
+    one from its parent (per-job) budget, and fails if either is exhausted.
+    """
+
+    def __init__(self, limit, parent=None):
+        """Initialize the budget
+
+        Args:
+            limit: Number of retries allowed (None for unlimited)
+            parent: Optional RetryBudget that is charged as well
+        """
+        self.limit = limit
+        self.parent = parent
+        self.used = 0
+        self._lock = threading.Lock()
+
+    def take(self):
+        """Consume one retry
+
+        Returns:
+            bool: True if the retry is allowed, False if a budget is used up
+        """
+        with self._lock:
+            if self.limit is not None and self.used >= self.limit:
+                return False
+            if self.parent is not None and not self.parent.take():
+                return False
+            self.used += 1
+            return True
+
+    def reset(self):
+        """Make the whole budget available again (parents are not touched)"""
+        with self._lock:
+            self.used = 0
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+On-disk journal of in-progress multipart uploads
+
+Each entry records the S3 upload session returned by upload_request
+(Bucket, Key, UploadId, StorageNode, FileId), the part size that was used
+and the parts known to be uploaded. Entries are keyed by
+(local file, md5, parent folder id), so an interrupted upload of the same
+content into the same folder can continue where it stopped instead of
+starting over from part 1.
+
+The server's part listing remains the source of truth: the journal only
+remembers which upload session to ask about.
+"""
+
+import os
+import json
+import time
+import atexit
+import threading
+from tosasitill_123pan import config
+
+
+class UploadJournal:
+    """Thread-safe JSON journal of resumable uploads
+
+    Writes are coalesced: part completions are flushed at most every
+    config.UPLOAD_JOURNAL_FLUSH_INTERVAL seconds, on start/finish of an
+    upload, and at exit.
+    """
+
+    def __init__(self, journal_path=None):
+        """Load the journal, dropping entries older than UPLOAD_JOURNAL_MAX_AGE_HOURS
+
+        Args:
+            journal_path: Path to the journal file (default: config.UPLOAD_JOURNAL_FILE)
+        """
+        self.journal_path = os.path.expanduser(journal_path or config.UPLOAD_JOURNAL_FILE)
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._last_flush = 0.0
+        self._entries = {}
+
+        try:
+            with open(self.journal_path, "r", encoding="utf-8") as f:
+                self._entries = json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            print(f"Warning: Ignoring unreadable upload journal {self.journal_path}: {e}")
+
+        cutoff = time.time() - config.UPLOAD_JOURNAL_MAX_AGE_HOURS * 3600
+        for key in [k for k, v in self._entries.items() if v.get("updatedAt", 0) < cutoff]:
+            del self._entries[key]
+            self._dirty = True
+
+        atexit.register(self.flush)
+
+    @staticmethod
+    def make_key(file_path, md5, parent_id):
+        """Build the journal key for an upload
+
+        Args:
+            file_path: Path to the local file
+            md5: MD5 of the file
+            parent_id: Remote parent folder ID
+
+        Returns:
+            str: Journal key
+        """
+        return f"{os.path.abspath(file_path)}|{md5.lower()}|{parent_id}"
+
+    def get(self, key):
+        """Return a copy of the journal entry for key, or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            return json.loads(json.dumps(entry)) if entry else None
+
+    def start(self, key, upload_data, block_size, file_size):
+        """Record a new upload session
+
+        Args:
+            key: Journal key from make_key()
+            upload_data: 'data' dict of the upload_request response
+            block_size: Part size used for this upload
+            file_size: Size of the local file
+        """
+        with self._lock:
+            self._entries[key] = {
+                "Bucket": upload_data["Bucket"],
+                "Key": upload_data["Key"],
+                "UploadId": upload_data["UploadId"],
+                "StorageNode": upload_data["StorageNode"],
+                "FileId": upload_data["FileId"],
+                "blockSize": block_size,
+                "size": file_size,
+                "parts": [],
+                "updatedAt": time.time(),
+            }
+            self._dirty = True
+        self.flush()
+
+    def add_part(self, key, part_number):
+        """Record a completed part (flushed lazily)"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            entry["parts"].append(part_number)
+            entry["updatedAt"] = time.time()
+            self._dirty = True
+            due = time.monotonic() - self._last_flush >= config.UPLOAD_JOURNAL_FLUSH_INTERVAL
+        if due:
+            self.flush()
+
+    def set_parts(self, key, part_numbers):
+        """Replace the completed part list (after reconciling with the server)"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            entry["parts"] = sorted(part_numbers)
+            entry["updatedAt"] = time.time()
+            self._dirty = True
+
+    def remove(self, key):
+        """Forget an upload (finished, or its session is no longer valid)"""
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self._dirty = True
+        self.flush()
+
+    def flush(self):
+        """Write the journal to disk atomically if it changed"""
+        with self._lock:
+            if not self._dirty:
+                return
+            data = json.dumps(self._entries)
+            self._dirty = False
+            self._last_flush = time.monotonic()
+            tmp_path = f"{self.journal_path}.tmp"
+            try:
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    f.write(data)
+                os.replace(tmp_path, self.journal_path)
+            except OSError as e:
+                self._dirty = True
+                print(f"Warning: Failed to write upload journal: {e}")